@@ -16,8 +16,12 @@ class AbstractDataModule(pl.LightningDataModule):
     def prepare_data(self, datasets) -> None:
         batch_size = self.cfg.train.batch_size
         num_workers = self.cfg.train.num_workers
+        # Pinned batches let the host-to-device copy overlap with the previous step
+        loader_kwargs = {'pin_memory': torch.cuda.is_available()}
+        if num_workers > 0:
+            loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
         self.dataloaders = {split: DataLoader(dataset, batch_size=batch_size, num_workers=num_workers,
-                                              shuffle='debug' not in self.cfg.general.name)
+                                              shuffle='debug' not in self.cfg.general.name, **loader_kwargs)
                             for split, dataset in datasets.items()}
 
     def train_dataloader(self):
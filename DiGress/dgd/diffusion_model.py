@@ -113,6 +113,10 @@ class LiftedDenoisingDiffusion(pl.LightningModule):
         self.best_val_nll = 1e8
         self.val_counter = 0
 
+    def transfer_batch_to_device(self, batch, device, dataloader_idx):
+        # Lightning only copies plain tensors asynchronously, not PyG batches
+        return batch.to(device, non_blocking=True)
+
     def training_step(self, data, i):
         dense_data, node_mask = utils.to_dense(
             x=data.x,
@@ -833,10 +837,12 @@ class LiftedDenoisingDiffusion(pl.LightningModule):
 
         # Split the generated molecules
         molecule_list = []
+        # One device-to-host copy for the whole batch instead of a synchronizing copy per molecule
+        X, E, n_nodes = X.cpu(), E.cpu(), n_nodes.cpu()
         for i in range(batch_size):
             n = n_nodes[i]
-            atom_types = X[i, :n].cpu()
-            edge_types = E[i, :n, :n].cpu()
+            atom_types = X[i, :n]
+            edge_types = E[i, :n, :n]
             molecule_list.append([atom_types, edge_types])
 
         # Visualize chains
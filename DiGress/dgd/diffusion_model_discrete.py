@@ -141,6 +141,10 @@ class DiscreteDenoisingDiffusion(pl.LightningModule):
         self.best_val_nll = 1e8
         self.val_counter = 0
 
+    def transfer_batch_to_device(self, batch, device, dataloader_idx):
+        # Lightning only copies plain tensors asynchronously, not PyG batches
+        return batch.to(device, non_blocking=True)
+
     def training_step(self, data, i):
         dense_data, node_mask = utils.to_dense(
             data.x, data.edge_index, data.edge_attr, data.batch
@@ -759,23 +763,21 @@ class DiscreteDenoisingDiffusion(pl.LightningModule):
             chain_E = torch.cat([chain_E, chain_E[-1:].repeat(10, 1, 1, 1)], dim=0)
             assert chain_X.size(0) == (number_chain_steps + 10)
 
+        # One device-to-host copy for the whole batch instead of a synchronizing copy per molecule
+        X, E, n_nodes = X.cpu(), E.cpu(), n_nodes.cpu()
+
         molecule_list = []
+        predicted_graph_list = []
         for i in range(batch_size):
             n = n_nodes[i]
-            atom_types = X[i, :n].cpu()
-            edge_types = E[i, :n, :n].cpu()
+            atom_types = X[i, :n]
+            edge_types = E[i, :n, :n]
             molecule_list.append([atom_types, edge_types])
+            predicted_graph_list.append([atom_types, edge_types])
             if i < 3:
                 print("Example of generated E: ", atom_types)
                 print("Example of generated X: ", edge_types)
 
-        predicted_graph_list = []
-        for i in range(batch_size):
-            n = n_nodes[i]
-            atom_types = X[i, :n].cpu()
-            edge_types = E[i, :n, :n].cpu()
-            predicted_graph_list.append([atom_types, edge_types])
-
         # Visualize chains
         if self.visualization_tools is not None:
             print("Visualizing chains...")
@@ -899,8 +901,10 @@ class DiscreteDenoisingDiffusion(pl.LightningModule):
         """At every training step (after adding noise) and step in sampling, compute extra information and append to
         the network input."""
 
-        extra_features = self.extra_features(noisy_data)
-        extra_molecular_features = self.domain_features(noisy_data)
+        # Cycle counts and Laplacian eigendecompositions are not safe in reduced precision
+        with torch.autocast(device_type=noisy_data["X_t"].device.type, enabled=False):
+            extra_features = self.extra_features(noisy_data)
+            extra_molecular_features = self.domain_features(noisy_data)
 
         extra_X = torch.cat((extra_features.X, extra_molecular_features.X), dim=-1)
         extra_E = torch.cat((extra_features.E, extra_molecular_features.E), dim=-1)
@@ -20,7 +20,7 @@ from pytorch_lightning.callbacks import ModelCheckpoint
 from pytorch_lightning.utilities.warnings import PossibleUserWarning
 
 from dgd import utils
-from dgd.datasets import guacamol_dataset, qm9_dataset, moses_dataset, molecule_dataset
+from dgd.datasets import guacamol_dataset, moses_dataset, molecule_dataset
 from dgd.datasets.spectre_dataset import (
     SBMDataModule,
     Comm20DataModule,
@@ -49,6 +49,15 @@ from dgd.diffusion.extra_features_molecular import ExtraMolecularFeatures
 
 warnings.filterwarnings("ignore", category=PossibleUserWarning)
 
+WANDB_SETTINGS = wandb.Settings(_disable_stats=True)
+# Text files a run writes to its working directory, watched by wandb for the whole run
+WANDB_SAVE_PATTERNS = ("final_smiles.txt", "*_counts.txt", "*_types.txt", "*valencies.txt")
+
+# DiGress main directory, `general.resume` paths are relative to it
+ROOT_DIR = pathlib.Path(
+    os.environ.get("DIGRESS_ROOT", pathlib.Path(__file__).resolve().parents[1])
+)
+
 
 def get_resume(cfg, model_kwargs):
     """Resumes a run. It loads previous config without allowing to update keys (used for testing)."""
@@ -73,11 +82,7 @@ def get_resume(cfg, model_kwargs):
 def get_resume_adaptive(cfg, model_kwargs):
     """Resumes a run. It loads previous config but allows to make some changes (used for resuming training)."""
     saved_cfg = cfg.copy()
-    # Fetch path to this file to get base path
-    current_path = os.path.dirname(os.path.realpath(__file__))
-    root_dir = current_path.split("outputs")[0]
-
-    resume_path = os.path.join(root_dir, cfg.general.resume)
+    resume_path = str(ROOT_DIR / cfg.general.resume)
 
     if cfg.model.type == "discrete":
         model = DiscreteDenoisingDiffusion.load_from_checkpoint(
@@ -87,20 +92,33 @@ def get_resume_adaptive(cfg, model_kwargs):
         model = LiftedDenoisingDiffusion.load_from_checkpoint(
             resume_path, **model_kwargs
         )
-    new_cfg = model.cfg
-
-    for category in cfg:
-        for arg in cfg[category]:
-            new_cfg[category][arg] = cfg[category][arg]
+    new_cfg = omegaconf.OmegaConf.merge(model.cfg, cfg)
 
     new_cfg.general.resume = resume_path
     new_cfg.general.name = new_cfg.general.name + "_resume"
 
-    new_cfg = cfg.update_config_with_new_keys(new_cfg, saved_cfg)
+    new_cfg = utils.update_config_with_new_keys(new_cfg, saved_cfg)
     return new_cfg, model
 
 
-def setup_wandb(cfg):
+def get_run_dir(checkpoint_path):
+    """Absolute directory of the run that produced `checkpoint_path` (the parent of its `checkpoints/` folder)."""
+    checkpoint_path = pathlib.Path(checkpoint_path).resolve()
+    for parent in checkpoint_path.parents:
+        if parent.name == "checkpoints":
+            return parent.parent
+    return checkpoint_path.parent
+
+
+def setup_wandb(cfg, configured_name=None):
+    """`configured_name` is general.name as given by the user, before main() renames the run."""
+    if configured_name in ("test", "debug"):
+        # Short debugging runs are not worth the wandb handshake. init() is still called in disabled
+        # mode so that the wandb.log calls in the models become no-ops.
+        cfg.general.wandb = "disabled"
+    if int(os.environ.get("LOCAL_RANK", os.environ.get("RANK", 0))) != 0:
+        # DDP reruns main() on every rank, only rank 0 reports to wandb
+        cfg.general.wandb = "disabled"
     config_dict = omegaconf.OmegaConf.to_container(
         cfg, resolve=True, throw_on_missing=True
     )
@@ -108,22 +126,30 @@ def setup_wandb(cfg):
         "name": cfg.general.name,
         "project": f"graph_ddm_{cfg.dataset.name}",
         "config": config_dict,
-        "settings": wandb.Settings(_disable_stats=True),
+        "settings": WANDB_SETTINGS,
         "reinit": True,
         "mode": cfg.general.wandb,
     }
     wandb.init(**kwargs)
-    wandb.save("*.txt")
+    if cfg.general.wandb != "disabled":
+        for pattern in WANDB_SAVE_PATTERNS:
+            wandb.save(pattern)
     return cfg
 
 
 @hydra.main(version_base="1.1", config_path="../configs", config_name="config")
 def main(cfg: DictConfig):
+    # Let fp32 matmuls run on TF32 tensor cores (Ampere+), the denoiser is matmul bound.
+    # Same as set_float32_matmul_precision("high"), which needs torch >= 1.12
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
     dataset_config = cfg["dataset"]
 
     max_num_atoms = int(cfg["max_num_atoms"])
     assert max_num_atoms > 0
 
+    configured_name = cfg.general.name
     cfg.general.name = f"v2-{cfg.model.type}-{max_num_atoms}"
 
     if dataset_config["name"] in ["sbm", "comm-20", "planar"]:
@@ -175,16 +201,6 @@ def main(cfg: DictConfig):
             dataset_infos = molecule_dataset.MoleculesInfos(
                 datamodule=datamodule, cfg=cfg, types=datamodule.types
             )
-        elif dataset_config["name"] == "qm9":
-            datamodule = qm9_dataset.QM9DataModule(cfg)
-            dataset_infos = qm9_dataset.QM9infos(datamodule=datamodule, cfg=cfg)
-            datamodule.prepare_data()
-            train_smiles = qm9_dataset.get_train_smiles(
-                cfg=cfg,
-                train_dataloader=datamodule.train_dataloader(),
-                dataset_infos=dataset_infos,
-                evaluate_dataset=False,
-            )
         elif dataset_config["name"] == "guacamol":
             datamodule = guacamol_dataset.GuacamolDataModule(cfg)
             dataset_infos = guacamol_dataset.Guacamolinfos(datamodule, cfg)
@@ -236,17 +252,21 @@ def main(cfg: DictConfig):
     else:
         raise NotImplementedError("Unknown dataset {}".format(cfg["dataset"]))
 
+    run_dir = None
     if cfg.general.test_only:
         # When testing, previous configuration is fully loaded
         cfg, _ = get_resume(cfg, model_kwargs)
-        os.chdir(cfg.general.test_only.split("checkpoints")[0])
+        run_dir = get_run_dir(cfg.general.test_only)
     elif cfg.general.resume is not None:
         # When resuming, we can override some parts of previous configuration
         cfg, _ = get_resume_adaptive(cfg, model_kwargs)
-        os.chdir(cfg.general.resume.split("checkpoints")[0])
+        run_dir = get_run_dir(cfg.general.resume)
+    if run_dir is not None:
+        # Graphs, chains and sampled SMILES are written relative to the working directory
+        os.chdir(run_dir)
 
     utils.create_folders(cfg)
-    cfg = setup_wandb(cfg)
+    cfg = setup_wandb(cfg, configured_name)
 
     if cfg.model.type == "discrete":
         model = DiscreteDenoisingDiffusion(cfg=cfg, **model_kwargs)
@@ -254,8 +274,13 @@ def main(cfg: DictConfig):
         model = LiftedDenoisingDiffusion(cfg=cfg, **model_kwargs)
 
     callbacks = []
+    # CKPT_DIR lets cluster runs checkpoint to fast local scratch instead of the shared mount
+    checkpoint_dir = (
+        pathlib.Path(os.environ.get("CKPT_DIR", ROOT_DIR / "checkpoints"))
+        / cfg.general.name
+    )
     checkpoint_callback = ModelCheckpoint(
-        dirpath=f"/app/DiGress/checkpoints/{cfg.general.name}",
+        dirpath=str(checkpoint_dir),
         filename="{epoch}",
         monitor="val/epoch_NLL",
         save_top_k=5,
@@ -275,10 +300,22 @@ def main(cfg: DictConfig):
         )
     elif name == "debug":
         print("[WARNING]: Run is called 'debug' -- it will run with fast_dev_run. ")
+    # "auto" uses bf16 where the GPU supports it and fp32 otherwise; fp16 has to be
+    # asked for explicitly with precision=16
+    precision = cfg.train.get("precision", "auto")
+    if precision == "auto":
+        bf16 = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+        precision = "bf16" if bf16 else 32
+    if isinstance(cfg.general.gpus, omegaconf.ListConfig):
+        devices = list(cfg.general.gpus)
+    else:
+        devices = [cfg.general.gpus]
+    use_ddp = torch.cuda.is_available() and len(devices) > 1
     trainer = Trainer(
         gradient_clip_val=cfg.train.clip_grad,
+        precision=precision,
         accelerator="gpu" if torch.cuda.is_available() else "cpu",
-        devices=[cfg.general.gpus] if torch.cuda.is_available() else None,
+        devices=devices if torch.cuda.is_available() else None,
         limit_train_batches=20 if name == "test" else None,
         limit_val_batches=20 if name == "test" else None,
         limit_test_batches=20 if name == "test" else None,
@@ -286,7 +323,7 @@ def main(cfg: DictConfig):
         max_epochs=cfg.train.n_epochs,
         check_val_every_n_epoch=cfg.general.check_val_every_n_epochs,
         fast_dev_run=cfg.general.name == "debug",
-        strategy=None,
+        strategy="ddp_find_unused_parameters_false" if use_ddp else None,
         enable_progress_bar=False,
         callbacks=callbacks,
         logger=[],
@@ -298,6 +335,13 @@ def main(cfg: DictConfig):
             trainer.test(model, datamodule=datamodule)
     else:
         model = model.to("cuda" if torch.cuda.is_available() else "cpu")
+        if cfg.train.compile_model and not hasattr(torch, "compile"):
+            warnings.warn("train.compile_model needs torch>=2.0, sampling eagerly.")
+        elif cfg.train.compile_model:
+            # Only the sampling rollout is compiled, training batches vary too much in shape and would keep recompiling
+            model.model = torch.compile(
+                model.model, mode=cfg.train.compile_mode, dynamic=False
+            )
         n_generated = 0
         while n_generated < cfg.general.samples_to_generate_at_test:
             print(f"Generated {n_generated}")
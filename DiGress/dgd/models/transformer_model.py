@@ -253,8 +253,7 @@ class GraphTransformer(nn.Module):
     def forward(self, X, E, y, node_mask):
         bs, n = X.shape[0], X.shape[1]
 
-        diag_mask = torch.eye(n)
-        diag_mask = ~diag_mask.type_as(E).bool()
+        diag_mask = ~torch.eye(n, dtype=torch.bool, device=E.device)
         diag_mask = diag_mask.unsqueeze(0).unsqueeze(-1).expand(bs, -1, -1, -1)
 
         X_to_out = X[..., :self.out_dim_X]
@@ -0,0 +1,51 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+import omegaconf
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path = [ROOT, os.path.join(ROOT, "dgd")] + sys.path
+
+from dgd import main  # noqa: E402
+
+
+def make_cfg():
+    # main() renames every run before calling setup_wandb
+    return omegaconf.OmegaConf.create(
+        {
+            "general": {"name": "v2-discrete-9", "wandb": "online"},
+            "dataset": {"name": "moses"},
+        }
+    )
+
+
+class TestSetupWandb(unittest.TestCase):
+    def run_setup(self, configured_name):
+        with mock.patch.object(main.wandb, "init") as init, mock.patch.object(
+            main.wandb, "save"
+        ) as save:
+            cfg = main.setup_wandb(make_cfg(), configured_name)
+        return cfg, init, save
+
+    def test_debug_run_disabled(self):
+        cfg, init, save = self.run_setup("debug")
+        self.assertEqual(cfg.general.wandb, "disabled")
+        self.assertEqual(init.call_args.kwargs["mode"], "disabled")
+        save.assert_not_called()
+
+    def test_non_zero_rank_disabled(self):
+        with mock.patch.dict(os.environ, {"LOCAL_RANK": "1"}):
+            cfg, init, save = self.run_setup("moses")
+        self.assertEqual(init.call_args.kwargs["mode"], "disabled")
+        save.assert_not_called()
+
+    def test_named_run_online(self):
+        cfg, init, save = self.run_setup("moses")
+        self.assertEqual(init.call_args.kwargs["mode"], "online")
+        self.assertEqual(save.call_count, len(main.WANDB_SAVE_PATTERNS))
+
+
+if __name__ == "__main__":
+    unittest.main()
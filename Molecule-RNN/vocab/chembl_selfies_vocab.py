@@ -1,32 +1,69 @@
 """
 Generate the vocabulary of the selfies of the smiles in the dataset
 """
+import multiprocessing as mp
+import os
+import re
+import string
+
 import typer
 import yaml
 import selfies as sf
 from tqdm import tqdm
 
+# libyaml's emitter when PyYAML was built with it
+Dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+# Every SELFIES symbol is bracketed, anything outside brackets ("." separators) is not a token
+SELFIES_TOKEN = re.compile(r"\[[^\]]*\]")
+
+# Characters that can appear in a SMILES string at all
+SMILES_CHARS = frozenset(string.ascii_letters + string.digits + "()[]=#$:+-@/\\%.*")
+
+
+def is_plausible_smiles(smiles):
+    """Cheap syntactic check to skip strings the encoder would reject anyway."""
+    return (
+        smiles != ""
+        and SMILES_CHARS.issuperset(smiles)
+        and smiles.count("(") == smiles.count(")")
+        and smiles.count("[") == smiles.count("]")
+    )
+
 
 def read_smiles_file(path, percentage):
+    """Lazily yield the first `percentage` of the SMILES in the file."""
+    with open(path, "r") as f:
+        num_data = sum(1 for _ in f)
+    cutoff = int(num_data * percentage)
     with open(path, "r") as f:
-        smiles = [line.strip("\n") for line in f.readlines()]
-    num_data = len(smiles)
-    return smiles[0 : int(num_data * percentage)]
+        for i, line in enumerate(f):
+            if i >= cutoff:
+                break
+            yield line[:-1] if line.endswith("\n") else line
+
+
+def selfies_tokens(smiles):
+    """Encode a SMILES to SELFIES and return the set of its tokens."""
+    if not is_plausible_smiles(smiles):
+        return set()
+    selfies = sf.encoder(smiles)
+    if selfies is None:
+        return set()
+    return set(SELFIES_TOKEN.findall(selfies))
 
 
 def main(dataset_path, output_vocab):
     smiles = read_smiles_file(dataset_path, 1)
-    selfies = []
-    for x in tqdm(smiles):
-        x = sf.encoder(x)
-        if x is not None:
-            selfies.append(x)
-
-    print("getting alphabet from selfies...")
-    vocab = sf.get_alphabet_from_selfies(selfies)
+    # Collect the alphabet while encoding instead of keeping every SELFIES around
+    vocab = set()
+    with mp.Pool(os.cpu_count()) as pool:
+        # Tokenize in the workers so only small token sets are sent back, not whole SELFIES
+        for tokens in tqdm(pool.imap_unordered(selfies_tokens, smiles, chunksize=1024)):
+            vocab.update(tokens)
 
     vocab_dict = {}
-    for i, token in enumerate(vocab):
+    for i, token in enumerate(sorted(vocab)):
         vocab_dict[token] = i
 
     i += 1
@@ -37,7 +74,7 @@ def main(dataset_path, output_vocab):
     vocab_dict["<pad>"] = i
 
     with open(output_vocab, "w") as f:
-        yaml.dump(vocab_dict, f)
+        yaml.dump(vocab_dict, f, Dumper=Dumper, sort_keys=True)
 
 
 if __name__ == "__main__":
@@ -115,7 +115,9 @@ class CCGVAE(ChemModel):
                 "check_overlap_edge": False,
                 "truncate_distance": 10,
                 "use_gpu": True,
+                "use_xla": False,  # XLA JIT compilation of the graph (fuses the GNN matmuls and gates)
                 "use_rec_multi_threads": True,
+                "log_every": 50,  # print the running losses every log_every batches
             }
         )
 
@@ -142,10 +144,10 @@ class CCGVAE(ChemModel):
         self.placeholders["num_vertices"] = tf.placeholder(
             tf.int32, (), name="num_vertices"
         )
-        # adj for encoder
+        # adj for encoder, edge type major so the GNN can index it without a transpose
         self.placeholders["adjacency_matrix"] = tf.placeholder(
-            tf.float32, [None, self.num_edge_types, None, None], name="adjacency_matrix"
-        )  # [b, e, v, v]
+            tf.float32, [self.num_edge_types, None, None, None], name="adjacency_matrix"
+        )  # [e, b, v, v]
         # labels for node symbol prediction
         self.placeholders["node_symbols"] = tf.placeholder(
             tf.float32, [None, None, self.params["num_symbols"]]
@@ -192,9 +194,19 @@ class CCGVAE(ChemModel):
         self.placeholders["local_stop"] = tf.placeholder(
             tf.float32, [None, None], name="local_stop"
         )  # [b, es]
-        # z_prior sampled from standard normal distribution
-        self.placeholders["z_prior"] = tf.placeholder(
-            tf.float32, [None, None, h_dim_en], name="z_prior"
+        # z_prior sampled from standard normal distribution, in graph unless it is fed (generation)
+        self.placeholders["z_prior"] = tf.placeholder_with_default(
+            tf.random_normal(
+                tf.stack(
+                    [
+                        self.placeholders["num_graphs"],
+                        self.placeholders["num_vertices"],
+                        h_dim_en,
+                    ]
+                )
+            ),
+            [None, None, h_dim_en],
+            name="z_prior",
         )  # the prior of z sampled from normal distribution
         # put in front of kl latent loss
         self.placeholders["kl_trade_off_lambda"] = tf.placeholder(
@@ -1295,7 +1307,6 @@ class CCGVAE(ChemModel):
             raw_data, bucket_sizes, file_name
         )
         bucketed = defaultdict(list)
-        x_dim = len(raw_data[0]["node_features"][0])
 
         for d, (
             incremental_adj_mat,
@@ -1334,11 +1345,11 @@ class CCGVAE(ChemModel):
                     "edge_labels": edge_labels,
                     "local_stop": local_stop,
                     "number_iteration": len(local_stop),
-                    "init": d["node_features"]
-                    + [
-                        [0 for _ in range(x_dim)]
-                        for __ in range(chosen_bucket_size - n_active_nodes)
-                    ],
+                    "init": np.pad(
+                        d["node_features"],
+                        ((0, chosen_bucket_size - n_active_nodes), (0, 0)),
+                        "constant",
+                    ),
                     "labels": [
                         d["targets"][task_id][0] for task_id in self.params["task_ids"]
                     ],
@@ -1396,90 +1407,53 @@ class CCGVAE(ChemModel):
             "hist": [],
         }
         for d in elements:
-            # sparse to dense for saving memory
+            # sparse to dense for saving memory, zero padded to the batch's number of iterations
             incre_adj_mat = incre_adj_mat_to_dense(
-                d["incre_adj_mat"], self.num_edge_types, maximum_vertice_num
+                d["incre_adj_mat"],
+                self.num_edge_types,
+                maximum_vertice_num,
+                max_iteration_num,
             )
             distance_to_others = distance_to_others_dense(
-                d["distance_to_others"], maximum_vertice_num
+                d["distance_to_others"], maximum_vertice_num, max_iteration_num
             )
             overlapped_edge_features = overlapped_edge_features_to_dense(
-                d["overlapped_edge_features"], maximum_vertice_num
+                d["overlapped_edge_features"], maximum_vertice_num, max_iteration_num
             )
             node_sequence = node_sequence_to_dense(
-                d["node_sequence"], maximum_vertice_num
+                d["node_sequence"], maximum_vertice_num, max_iteration_num
             )
             edge_type_masks = edge_type_masks_to_dense(
-                d["edge_type_masks"], maximum_vertice_num, self.num_edge_types
+                d["edge_type_masks"],
+                maximum_vertice_num,
+                self.num_edge_types,
+                max_iteration_num,
             )
             edge_type_labels = edge_type_labels_to_dense(
-                d["edge_type_labels"], maximum_vertice_num, self.num_edge_types
+                d["edge_type_labels"],
+                maximum_vertice_num,
+                self.num_edge_types,
+                max_iteration_num,
+            )
+            edge_masks = edge_masks_to_dense(
+                d["edge_masks"], maximum_vertice_num, max_iteration_num
+            )
+            edge_labels = edge_labels_to_dense(
+                d["edge_labels"], maximum_vertice_num, max_iteration_num
             )
-            edge_masks = edge_masks_to_dense(d["edge_masks"], maximum_vertice_num)
-            edge_labels = edge_labels_to_dense(d["edge_labels"], maximum_vertice_num)
 
             batch_data["adj_mat"].append(d["adj_mat"])
             batch_data["init"].append(d["init"])
             batch_data["node_mask"].append(d["mask"])
 
-            batch_data["incre_adj_mat"].append(
-                incre_adj_mat
-                + [
-                    np.zeros(
-                        (self.num_edge_types, maximum_vertice_num, maximum_vertice_num)
-                    )
-                    for _ in range(max_iteration_num - d["number_iteration"])
-                ]
-            )
-            batch_data["distance_to_others"].append(
-                distance_to_others
-                + [
-                    np.zeros((maximum_vertice_num))
-                    for _ in range(max_iteration_num - d["number_iteration"])
-                ]
-            )
-            batch_data["overlapped_edge_features"].append(
-                overlapped_edge_features
-                + [
-                    np.zeros((maximum_vertice_num))
-                    for _ in range(max_iteration_num - d["number_iteration"])
-                ]
-            )
-            batch_data["node_sequence"].append(
-                node_sequence
-                + [
-                    np.zeros((maximum_vertice_num))
-                    for _ in range(max_iteration_num - d["number_iteration"])
-                ]
-            )
-            batch_data["edge_type_masks"].append(
-                edge_type_masks
-                + [
-                    np.zeros((self.num_edge_types, maximum_vertice_num))
-                    for _ in range(max_iteration_num - d["number_iteration"])
-                ]
-            )
-            batch_data["edge_masks"].append(
-                edge_masks
-                + [
-                    np.zeros((maximum_vertice_num))
-                    for _ in range(max_iteration_num - d["number_iteration"])
-                ]
-            )
-            batch_data["edge_type_labels"].append(
-                edge_type_labels
-                + [
-                    np.zeros((self.num_edge_types, maximum_vertice_num))
-                    for _ in range(max_iteration_num - d["number_iteration"])
-                ]
-            )
-            batch_data["edge_labels"].append(
-                edge_labels
-                + [
-                    np.zeros((maximum_vertice_num))
-                    for _ in range(max_iteration_num - d["number_iteration"])
-                ]
-            )
+            batch_data["incre_adj_mat"].append(incre_adj_mat)
+            batch_data["distance_to_others"].append(distance_to_others)
+            batch_data["overlapped_edge_features"].append(overlapped_edge_features)
+            batch_data["node_sequence"].append(node_sequence)
+            batch_data["edge_type_masks"].append(edge_type_masks)
+            batch_data["edge_masks"].append(edge_masks)
+            batch_data["edge_type_labels"].append(edge_type_labels)
+            batch_data["edge_labels"].append(edge_labels)
             batch_data["iteration_mask"].append(
                 [1 for _ in range(d["number_iteration"])]
                 + [0 for _ in range(max_iteration_num - d["number_iteration"])]
@@ -1543,7 +1517,9 @@ class CCGVAE(ChemModel):
             self.placeholders["num_vertices"]: num_vertices,  # v
             self.placeholders["node_symbols"]: [elements["init"]],
             self.ops["latent_node_symbols"]: latent_node_symbol,
-            self.placeholders["adjacency_matrix"]: [elements["adj_mat"]],
+            self.placeholders["adjacency_matrix"]: np.expand_dims(
+                elements["adj_mat"], 1
+            ),
             self.placeholders["node_mask"]: [elements["mask"]],
             self.placeholders["graph_state_keep_prob"]: 1,
             self.placeholders["edge_weight_dropout_keep_prob"]: 1,
@@ -1607,7 +1583,9 @@ class CCGVAE(ChemModel):
             self.placeholders["num_vertices"]: num_vertices,  # v
             self.ops["initial_nodes_decoder"]: latent_nodes,
             self.ops["latent_node_symbols"]: latent_node_symbol,
-            self.placeholders["adjacency_matrix"]: [elements["adj_mat"]],
+            self.placeholders["adjacency_matrix"]: np.expand_dims(
+                elements["adj_mat"], 1
+            ),
             self.placeholders["node_mask"]: [elements["mask"]],
             self.placeholders["graph_state_keep_prob"]: 1,
             self.placeholders["edge_weight_dropout_keep_prob"]: 1,
@@ -1633,7 +1611,9 @@ class CCGVAE(ChemModel):
             self.placeholders["num_vertices"]: num_vertices,  # v
             self.placeholders["node_mask"]: [elements["mask"]],
             self.placeholders["node_symbols"]: [elements["init"]],
-            self.placeholders["adjacency_matrix"]: [elements["adj_mat"]],
+            self.placeholders["adjacency_matrix"]: np.expand_dims(
+                elements["adj_mat"], 1
+            ),
             self.placeholders["graph_state_keep_prob"]: 1,
             self.placeholders["edge_weight_dropout_keep_prob"]: 1,
             self.placeholders["iteration_mask"]: [[1]],
@@ -2084,9 +2064,11 @@ class CCGVAE(ChemModel):
             get_graph_length([elements["mask"]])[0] + self.params["compensate_num"]
         )
         elements["mask"] = [1] * real_length + [0] * (maximum_length - real_length)
-        elements["init"] = np.zeros((maximum_length, self.params["num_symbols"]))
+        elements["init"] = np.zeros(
+            (maximum_length, self.params["num_symbols"]), dtype=np.float32
+        )
         elements["adj_mat"] = np.zeros(
-            (self.num_edge_types, maximum_length, maximum_length)
+            (self.num_edge_types, maximum_length, maximum_length), dtype=np.float32
         )
         return maximum_length
 
@@ -2286,7 +2268,9 @@ class CCGVAE(ChemModel):
                 ),
                 self.placeholders["num_graphs"]: num_graphs,
                 self.placeholders["num_vertices"]: bucket_sizes[bucket],
-                self.placeholders["adjacency_matrix"]: batch_data["adj_mat"],
+                self.placeholders["adjacency_matrix"]: np.stack(
+                    batch_data["adj_mat"], axis=1
+                ),
                 self.placeholders["node_mask"]: batch_data["node_mask"],
                 self.placeholders["graph_state_keep_prob"]: dropout_keep_prob,
                 self.placeholders[
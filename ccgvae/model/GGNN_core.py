@@ -4,7 +4,7 @@ import os
 import pickle
 import random
 import time
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Any
 
 import numpy as np
@@ -37,8 +37,7 @@ class ChemModel(object):
         params = self.default_params()
         config_file = args.get("--config-file")
         if config_file is not None:
-            with open(config_file, "r") as f:
-                params.update(json.load(f))
+            params.update(utils.load_json(config_file))
         config = args.get("--config")
         if config is not None:
             params.update(json.loads(config))
@@ -60,28 +59,28 @@ class ChemModel(object):
 
         # Get which dataset in use
         self.params["dataset"] = dataset = args.get("--dataset")
+        info = dataset_info(dataset)
         # Number of atom types of this dataset
-        self.params["num_symbols"] = len(dataset_info(dataset)["atom_types"])
+        self.params["num_symbols"] = len(info["atom_types"])
 
         suff = "_" + self.params["suffix"] if self.params["suffix"] is not None else ""
         self.run_id = "_".join([time.strftime("%Y-%m-%d-%H-%M-%S"), str(os.getpid())])
         log_dir = self.params["log_dir"]
         self.log_file = os.path.join(
             log_dir,
-            "%s_log_%s%s.json" % (self.run_id, safe_dataset(dataset), suff),
+            "%s_log_%s%s.jsonl" % (self.run_id, safe_dataset(dataset), suff),
         )
         self.best_model_file = os.path.join(
-            log_dir, "%s_model%s.pickle" % (self.run_id, suff)
+            log_dir, "%s_model%s.ckpt" % (self.run_id, suff)
         )
 
-        with open(
+        utils.dump_json(
+            params,
             os.path.join(
                 log_dir,
                 "%s_params_%s%s.json" % (self.run_id, dataset.replace("/", "_"), suff),
             ),
-            "w",
-        ) as f:
-            json.dump(params, f)
+        )
 
         print(
             "Run %s starting with following parameters:\n%s"
@@ -93,22 +92,23 @@ class ChemModel(object):
         np.random.seed(params["random_seed"])
 
         # Load data:
-        self.max_num_vertices = 0
+        self.max_num_vertices = info["max_n_atoms"]
         self.num_edge_types = 0
         self.annotation_size = 0
-        if self.params["generation"] == 0:
-            train_data, self.train_data = self.load_data(
-                params["train_file"], is_training_data=True
-            )
-        else:
-            train_data, self.train_data = self.load_data(
-                params["train_file"], is_training_data=False
-            )
+        # Read the three files concurrently, then process them in order so the seeded RNG draws stay the same
+        split_files = [params["train_file"], params["valid_file"], params["test_file"]]
+        with ThreadPoolExecutor(max_workers=len(split_files)) as executor:
+            raw_train, raw_valid, raw_test = executor.map(self.read_data, split_files)
+        train_data, self.train_data = self.load_data(
+            params["train_file"],
+            raw_train,
+            is_training_data=self.params["generation"] == 0,
+        )
         valid_data, self.valid_data = self.load_data(
-            params["valid_file"], is_training_data=False
+            params["valid_file"], raw_valid, is_training_data=False
         )
         test_data, self.test_data = self.load_data(
-            params["test_file"], is_training_data=False
+            params["test_file"], raw_test, is_training_data=False
         )
         print(
             len(train_data),
@@ -116,13 +116,8 @@ class ChemModel(object):
             len(test_data),
         )
         self.histograms = dict()
-        self.histograms["hist_dim"] = utils.dataset_info(self.params["dataset"])[
-            "hist_dim"
-        ]
-        self.histograms["max_valence"] = utils.dataset_info(self.params["dataset"])[
-            "max_valence_value"
-        ]
-        self.max_num_vertices = dataset_info(dataset)["max_n_atoms"]
+        self.histograms["hist_dim"] = info["hist_dim"]
+        self.histograms["max_valence"] = info["max_valence_value"]
         self.histograms["train"] = self.prepareHist(train_data)
         # A = number of atoms in a molecule, N = number of histograms
         # With filter we create a list of max(A) lists, which each list inside the main one are the weights for each histogram
@@ -140,6 +135,10 @@ class ChemModel(object):
         # Build the actual model
         config = tf.ConfigProto()
         config.gpu_options.allow_growth = True
+        if self.params["use_xla"]:
+            config.graph_options.optimizer_options.global_jit_level = (
+                tf.OptimizerOptions.ON_1
+            )
         self.graph = tf.Graph()
         self.sess = tf.Session(graph=self.graph, config=config)
         with self.graph.as_default():
@@ -149,7 +148,24 @@ class ChemModel(object):
             self.ops = {}
 
             self.make_model()
-            self.make_train_step()
+
+            # Only what run_epoch reads back, every extra fetch is a device-to-host copy
+            self.eval_fetches = [
+                self.ops["loss"],
+                self.ops["mean_edge_loss"],
+                self.ops["mean_node_symbol_loss"],
+                self.ops["mean_kl_loss"],
+                self.ops["mean_total_qed_loss"],
+                self.ops["node_loss_error"],
+                self.ops["node_pred_error"],
+            ]
+            # Generation, reconstruction and test only run forward: no gradients nor optimizer slots
+            if self.params["generation"] == 0:
+                self.make_train_step()
+                self.train_fetches = self.eval_fetches + [self.ops["train_step"]]
+
+            # The graph is rebuilt from code on restore, only the variable values are checkpointed
+            self.saver = tf.train.Saver(max_to_keep=1, save_relative_paths=True)
 
             # Restore/initialize variables:
             restore_file = args.get("--restore")
@@ -158,29 +174,29 @@ class ChemModel(object):
             else:
                 self.initialize_model()
 
-    def load_data(self, file_name, is_training_data: bool):
+    def read_data(self, file_name):
         full_path = os.path.join(self.data_dir, file_name)
 
         print("Loading data from %s" % full_path)
 
-        with open(full_path, "r") as f:
-            data = json.load(f)
+        return utils.load_json_cached(
+            full_path, os.path.join(os.path.dirname(full_path), ".cache")
+        )
 
+    def load_data(self, file_name, data, is_training_data: bool):
         restrict = self.args.get("--restrict_data")
         if restrict is not None and 0 < float(restrict) < 1:
-            idx = np.random.randint(
-                0, high=len(data), size=round(len(data) * float(restrict))
+            idx = np.random.choice(
+                len(data), size=round(len(data) * float(restrict)), replace=False
             )
-            data = [data[i] for i in idx]
+            data = [data[i] for i in idx.tolist()]
 
-        # Get some common data out:
-        num_fwd_edge_types = len(utils.bond_dict) - 1
+        # Node features as one contiguous float32 array per graph, so batching does not walk nested lists
         for g in data:
-            self.max_num_vertices = max(
-                self.max_num_vertices,
-                max([v for e in g["graph"] for v in [e[0], e[2]]]),
-            )
+            g["node_features"] = np.asarray(g["node_features"], dtype=np.float32)
 
+        # Get some common data out:
+        num_fwd_edge_types = len(utils.bond_dict) - 1
         self.num_edge_types = max(
             self.num_edge_types,
             num_fwd_edge_types * (1 if self.params["tie_fwd_bkwd"] else 2),
@@ -199,20 +215,21 @@ class ChemModel(object):
     """
 
     def prepareHist(self, data):
-        diz = defaultdict(list)
-        for i in data:
-            key = HM.histToScore(i["hist"], self.histograms["max_valence"])
-            diz[key].append(1)  # just a placeholder
-
-        array_number = []
-        array_hist = []
-        for hist in sorted(diz.keys()):
-            array_number.append(len(diz[hist]))
-            array_hist.append(
-                HM.scoreToHist(
-                    hist, self.histograms["hist_dim"], self.histograms["max_valence"]
-                )
+        scores = np.fromiter(
+            (HM.histToScore(i["hist"], self.histograms["max_valence"]) for i in data),
+            dtype=np.int64,
+            count=len(data),
+        )
+        # Sorted unique scores with the number of molecules sharing each of them
+        unique_scores, counts = np.unique(scores, return_counts=True)
+
+        array_number = counts.tolist()
+        array_hist = [
+            HM.scoreToHist(
+                score, self.histograms["hist_dim"], self.histograms["max_valence"]
             )
+            for score in unique_scores.tolist()
+        ]
 
         return [array_hist, array_number]
 
@@ -260,9 +277,7 @@ class ChemModel(object):
                         "final_node_representations"
                     ] = self.compute_final_node_representations_with_residual(
                         initial_state,
-                        tf.transpose(
-                            self.placeholders["adjacency_matrix"], [1, 0, 2, 3]
-                        ),
+                        self.placeholders["adjacency_matrix"],
                         "_encoder",
                     )
                 else:
@@ -270,9 +285,7 @@ class ChemModel(object):
                         "final_node_representations"
                     ] = self.compute_final_node_representations_without_residual(
                         initial_state,
-                        tf.transpose(
-                            self.placeholders["adjacency_matrix"], [1, 0, 2, 3]
-                        ),
+                        self.placeholders["adjacency_matrix"],
                         self.weights["edge_weights_encoder"],
                         self.weights["edge_biases_encoder"],
                         self.weights["node_gru_encoder"],
@@ -309,13 +322,13 @@ class ChemModel(object):
                     tf.GraphKeys.TRAINABLE_VARIABLES, scope="graph_model"
                 )
             )
-            filtered_vars = []
-            for var in trainable_vars:
-                if var not in graph_vars:
-                    filtered_vars.append(var)
-                else:
-                    print("Freezing weights of variable %s." % var.name)
-            trainable_vars = filtered_vars
+            frozen_vars = [var for var in trainable_vars if var in graph_vars]
+            if frozen_vars:
+                print(
+                    "Freezing weights of variables %s."
+                    % ", ".join(var.name for var in frozen_vars)
+                )
+            trainable_vars = [var for var in trainable_vars if var not in graph_vars]
 
         optimizer = tf.train.AdamOptimizer(self.params["learning_rate"])
         grads_and_vars = optimizer.compute_gradients(
@@ -323,21 +336,16 @@ class ChemModel(object):
         )
 
         clipped_grads = []
-        for grad, var in grads_and_vars:
-            if grad is not None:
-                clipped_grads.append(
-                    (tf.clip_by_norm(grad, self.params["clamp_gradient_norm"]), var)
-                )
-            else:
-                clipped_grads.append((grad, var))
         grads_for_display = []
         grads_for_display2 = []
         for grad, var in grads_and_vars:
             if grad is not None:
-                grads_for_display.append(
-                    (tf.clip_by_norm(grad, self.params["clamp_gradient_norm"]), var)
-                )
+                clipped_grad = tf.clip_by_norm(grad, self.params["clamp_gradient_norm"])
+                clipped_grads.append((clipped_grad, var))
+                grads_for_display.append((clipped_grad, var))
                 grads_for_display2.append(grad)
+            else:
+                clipped_grads.append((grad, var))
         self.ops["grads"] = grads_for_display
         self.ops["grads2"] = grads_for_display2
         self.ops["train_step"] = optimizer.apply_gradients(clipped_grads)
@@ -368,6 +376,13 @@ class ChemModel(object):
     def make_minibatch_iterator(self, data: Any, is_training: bool):
         raise Exception("Models have to implement make_minibatch_iterator!")
 
+    @staticmethod
+    def feed_dict_to_arrays(feed_dict):
+        return {
+            placeholder: np.asarray(value, dtype=placeholder.dtype.as_numpy_dtype)
+            for placeholder, value in feed_dict.items()
+        }
+
     def run_epoch(self, epoch_name: str, epoch_num, data, is_training: bool):
         print(
             "Starting %s epoch %i, is_training %s"
@@ -387,94 +402,62 @@ class ChemModel(object):
             teacher_forcing = True
         else:
             teacher_forcing = False
+        if is_training:
+            out_layer_dropout_keep_prob = self.params["out_layer_dropout_keep_prob"]
+            fetch_list = self.train_fetches
+        else:
+            out_layer_dropout_keep_prob = 1.0
+            fetch_list = self.eval_fetches
+        # Feeds that are the same for every batch of the epoch
+        epoch_feeds = {
+            self.placeholders["is_generative"]: False,
+            self.placeholders["use_teacher_forcing_nodes"]: teacher_forcing,
+            self.placeholders[
+                "out_layer_dropout_keep_prob"
+            ]: out_layer_dropout_keep_prob,
+        }
+
+        # Build the complete feed dicts in the producer thread, so the training loop only runs sess.run
+        def complete_feeds():
+            for batch_data in self.make_minibatch_iterator(data, is_training):
+                batch_data.update(epoch_feeds)
+                yield self.feed_dict_to_arrays(batch_data)
+
         batch_iterator = ThreadedIterator(
-            self.make_minibatch_iterator(data, is_training),
-            max_queue_size=self.params["batch_size"],
+            complete_feeds(), max_queue_size=self.params["batch_size"]
         )  # self.params['batch_size'])
 
         for step, batch_data in enumerate(batch_iterator):
             num_graphs = batch_data[self.placeholders["num_graphs"]]
             processed_graphs += num_graphs
-            batch_data[self.placeholders["is_generative"]] = False
-            batch_data[self.placeholders["use_teacher_forcing_nodes"]] = teacher_forcing
-            batch_data[self.placeholders["z_prior"]] = utils.generate_std_normal(
-                self.params["batch_size"],
-                batch_data[self.placeholders["num_vertices"]],
-                self.params["hidden_size_encoder"],
-            )
-
-            if is_training:
-                batch_data[
-                    self.placeholders["out_layer_dropout_keep_prob"]
-                ] = self.params["out_layer_dropout_keep_prob"]
-                fetch_list = [
-                    self.ops["loss"],
-                    self.ops["train_step"],
-                    self.ops["edge_loss"],
-                    self.ops["kl_loss"],
-                    self.ops["node_symbol_prob"],
-                    self.placeholders["node_symbols"],
-                    self.ops["qed_computed_values"],
-                    self.placeholders["target_values"],
-                    self.ops["total_qed_loss"],
-                    self.ops["mean"],
-                    self.ops["logvariance"],
-                    self.ops["grads"],
-                    self.ops["mean_edge_loss"],
-                    self.ops["mean_node_symbol_loss"],
-                    self.ops["mean_kl_loss"],
-                    self.ops["mean_total_qed_loss"],
-                    self.ops["grads2"],
-                    self.ops["node_loss_error"],
-                    self.ops["node_pred_error"],
-                ]
-            else:
-                batch_data[self.placeholders["out_layer_dropout_keep_prob"]] = 1.0
-                fetch_list = [
-                    self.ops["loss"],
-                    self.ops["mean_edge_loss"],
-                    self.ops["mean_node_symbol_loss"],
-                    self.ops["mean_kl_loss"],
-                    self.ops["mean_total_qed_loss"],
-                    self.ops["sampled_atoms"],
-                    self.ops["node_loss_error"],
-                    self.ops["node_pred_error"],
-                ]
             result = self.sess.run(fetch_list, feed_dict=batch_data)
             batch_loss = result[0]
             loss += batch_loss * num_graphs
-            if is_training:
-                mean_edge_loss += result[12] * num_graphs
-                mean_node_loss += result[13] * num_graphs
-                mean_kl_loss += result[14] * num_graphs
-                mean_qed_loss += result[15] * num_graphs
-                node_loss_error = max(node_loss_error, np.max(result[17]))
-                node_pred_error += result[18]
-            else:
-                mean_edge_loss += result[1] * num_graphs
-                mean_node_loss += result[2] * num_graphs
-                mean_kl_loss += result[3] * num_graphs
-                mean_qed_loss += result[4] * num_graphs
-                node_loss_error = max(node_loss_error, np.max(result[6]))
-                node_pred_error += result[7]
-
-            print(
-                "Running %s, batch %i (has %i graphs). Total loss: %.4f. Edge loss: %.4f. Node loss: %.4f. KL loss: %.4f. Property loss: %.4f. Node error: %.4f. Node pred: %.4f. processed_graphs: %i"
-                % (
-                    epoch_name,
-                    step,
-                    num_graphs,
-                    loss / processed_graphs,
-                    mean_edge_loss / processed_graphs,
-                    mean_node_loss / processed_graphs,
-                    mean_kl_loss / processed_graphs,
-                    mean_qed_loss / processed_graphs,
-                    node_loss_error,
-                    node_pred_error / processed_graphs,
-                    processed_graphs,
-                ),
-                end="\n",
-            )
+            mean_edge_loss += result[1] * num_graphs
+            mean_node_loss += result[2] * num_graphs
+            mean_kl_loss += result[3] * num_graphs
+            mean_qed_loss += result[4] * num_graphs
+            node_loss_error = max(node_loss_error, np.max(result[5]))
+            node_pred_error += result[6]
+
+            if step % self.params["log_every"] == 0:
+                print(
+                    "Running %s, batch %i (has %i graphs). Total loss: %.4f. Edge loss: %.4f. Node loss: %.4f. KL loss: %.4f. Property loss: %.4f. Node error: %.4f. Node pred: %.4f. processed_graphs: %i"
+                    % (
+                        epoch_name,
+                        step,
+                        num_graphs,
+                        loss / processed_graphs,
+                        mean_edge_loss / processed_graphs,
+                        mean_node_loss / processed_graphs,
+                        mean_kl_loss / processed_graphs,
+                        mean_qed_loss / processed_graphs,
+                        node_loss_error,
+                        node_pred_error / processed_graphs,
+                        processed_graphs,
+                    ),
+                    end="\n",
+                )
 
         print(processed_graphs, "processed_graphs")
         mean_edge_loss /= processed_graphs
@@ -499,6 +482,14 @@ class ChemModel(object):
     def reconstruction(self, data):
         raise Exception("Models have to implement generate_new_graphs!")
 
+    def run_and_log(self, phase: str, epoch_name: str, epoch_num, data, is_training):
+        results = self.run_epoch(epoch_name, epoch_num, data, is_training)
+        print(
+            "\n\x1b[K %s loss: %.5f | Edge loss: %.5f | Node loss: %.5f | KL loss: %.5f | QED loss: %.5f | instances/sec: %.2f"
+            % ((phase,) + results)
+        )
+        return results
+
     def train(self):
         if self.params["generation"] == 0:
             print("START TRAINING")
@@ -509,79 +500,37 @@ class ChemModel(object):
         elif self.params["generation"] == 3:
             print("START TEST")
         suff = "_" + self.params["suffix"] if self.params["suffix"] is not None else ""
-        log_to_save = []
         total_time_start = time.time()
         with self.graph.as_default():
             for epoch in range(1, self.params["num_epochs"] + 1):
                 if self.params["generation"] == 0:
                     print("========== EPOCH %i =================" % epoch)
 
-                    (
-                        loss,
-                        mean_edge_loss,
-                        mean_node_loss,
-                        mean_kl_loss,
-                        mean_qed_loss,
-                        instance_per_sec,
-                    ) = self.run_epoch(
-                        "epoch %i (training)" % epoch, epoch, self.train_data, True
-                    )
-
-                    print(
-                        "\n\x1b[K Train loss: %.5f | Edge loss: %.5f | Node loss: %.5f | KL loss: %.5f | QED loss: %.5f | instances/sec: %.2f"
-                        % (
-                            loss,
-                            mean_edge_loss,
-                            mean_node_loss,
-                            mean_kl_loss,
-                            mean_qed_loss,
-                            instance_per_sec,
-                        )
-                    )
-
-                    (
-                        loss,
-                        mean_edge_loss,
-                        mean_node_loss,
-                        mean_kl_loss,
-                        mean_qed_loss,
-                        instance_per_sec,
-                    ) = self.run_epoch(
-                        "epoch %i (validation)" % epoch, epoch, self.valid_data, False
+                    self.run_and_log(
+                        "Train",
+                        "epoch %i (training)" % epoch,
+                        epoch,
+                        self.train_data,
+                        True,
                     )
-
-                    print(
-                        "\n\x1b[K Valid loss: %.5f | Edge loss: %.5f | Node loss: %.5f | KL loss: %.5f | QED loss: %.5f | instances/sec: %.2f"
-                        % (
-                            loss,
-                            mean_edge_loss,
-                            mean_node_loss,
-                            mean_kl_loss,
-                            mean_qed_loss,
-                            instance_per_sec,
-                        )
+                    results = self.run_and_log(
+                        "Valid",
+                        "epoch %i (validation)" % epoch,
+                        epoch,
+                        self.valid_data,
+                        False,
                     )
 
                     epoch_time = time.time() - total_time_start
                     log_entry = {
                         "Epoch": epoch,
                         "Time": epoch_time,
-                        "Train_results": (
-                            loss,
-                            mean_edge_loss,
-                            mean_node_loss,
-                            mean_kl_loss,
-                            mean_qed_loss,
-                            instance_per_sec,
-                        ),
+                        "Train_results": results,
                     }
-                    log_to_save.append(log_entry)
-
-                    with open(self.log_file, "w") as f:
-                        json.dump(log_to_save, f, indent=4)
+                    utils.append_json_line(log_entry, self.log_file)
 
                     self.save_model(
-                        "%s%s.pickle" % (safe_dataset(self.params["dataset"]), suff)
+                        "%s%s.ckpt" % (safe_dataset(self.params["dataset"]), suff)
                     )
 
                     print("Generating new graphs")
@@ -592,87 +541,24 @@ class ChemModel(object):
                 elif self.params["generation"] == 2:
                     self.reconstruction(self.test_data)
                 elif self.params["generation"] == 3:  # validation only
-                    (
-                        loss,
-                        mean_edge_loss,
-                        mean_node_loss,
-                        mean_kl_loss,
-                        mean_qed_loss,
-                        instance_per_sec,
-                    ) = self.run_epoch(
-                        "epoch %i (training)" % epoch, epoch, self.train_data, False
-                    )
-
-                    print(
-                        "\n\x1b[K Train loss: %.5f | Edge loss: %.5f | Node loss: %.5f | KL loss: %.5f | QED loss: %.5f | instances/sec: %.2f"
-                        % (
-                            loss,
-                            mean_edge_loss,
-                            mean_node_loss,
-                            mean_kl_loss,
-                            mean_qed_loss,
-                            instance_per_sec,
-                        )
-                    )
-
-                    (
-                        loss,
-                        mean_edge_loss,
-                        mean_node_loss,
-                        mean_kl_loss,
-                        mean_qed_loss,
-                        instance_per_sec,
-                    ) = self.run_epoch(
-                        "epoch %i (valid)" % epoch, epoch, self.valid_data, False
-                    )
-
-                    print(
-                        "\n\x1b[K Valid loss: %.5f | Edge loss: %.5f | Node loss: %.5f | KL loss: %.5f | QED loss: %.5f | instances/sec: %.2f"
-                        % (
-                            loss,
-                            mean_edge_loss,
-                            mean_node_loss,
-                            mean_kl_loss,
-                            mean_qed_loss,
-                            instance_per_sec,
-                        )
+                    self.run_and_log(
+                        "Train",
+                        "epoch %i (training)" % epoch,
+                        epoch,
+                        self.train_data,
+                        False,
                     )
-
-                    (
-                        loss,
-                        mean_edge_loss,
-                        mean_node_loss,
-                        mean_kl_loss,
-                        mean_qed_loss,
-                        instance_per_sec,
-                    ) = self.run_epoch(
-                        "epoch %i (test)" % epoch, epoch, self.test_data, False
+                    self.run_and_log(
+                        "Valid", "epoch %i (valid)" % epoch, epoch, self.valid_data, False
                     )
-
-                    print(
-                        "\n\x1b[K Test loss: %.5f | Edge loss: %.5f | Node loss: %.5f | KL loss: %.5f | QED loss: %.5f | instances/sec: %.2f"
-                        % (
-                            loss,
-                            mean_edge_loss,
-                            mean_node_loss,
-                            mean_kl_loss,
-                            mean_qed_loss,
-                            instance_per_sec,
-                        )
+                    self.run_and_log(
+                        "Test", "epoch %i (test)" % epoch, epoch, self.test_data, False
                     )
                     exit(0)
 
     def save_model(self, path: str) -> None:
-        weights_to_save = {}
-        for variable in self.sess.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES):
-            assert variable.name not in weights_to_save
-            weights_to_save[variable.name] = self.sess.run(variable)
-
-        data_to_save = {"params": self.params, "weights": weights_to_save}
-
         log_dir = self.params["log_dir"]
-        with open(log_dir + "/" + path, "wb") as out_file:
-            pickle.dump(data_to_save, out_file, pickle.HIGHEST_PROTOCOL)
+        self.saver.save(self.sess, log_dir + "/" + path, write_meta_graph=False)
 
     def initialize_model(self) -> None:
         init_op = tf.group(
@@ -682,21 +568,30 @@ class ChemModel(object):
 
     def restore_model(self, path: str) -> None:
         print("Restoring weights from file %s." % path)
+        if not path.endswith(".pickle"):
+            self.saver.restore(self.sess, path)
+            return
+
+        # Checkpoints written before the switch to tf.train.Saver
         with open(path, "rb") as in_file:
             data_to_load = pickle.load(in_file)
 
         variables_to_initialize = []
         with tf.name_scope("restore"):
             restore_ops = []
+            # Values are fed rather than baked into the graph as constants
+            restore_feed_dict = {}
             used_vars = set()
             for variable in self.sess.graph.get_collection(
                 tf.GraphKeys.GLOBAL_VARIABLES
             ):
                 used_vars.add(variable.name)
                 if variable.name in data_to_load["weights"]:
-                    restore_ops.append(
-                        variable.assign(data_to_load["weights"][variable.name])
+                    value = tf.placeholder(
+                        variable.dtype.base_dtype, variable.get_shape()
                     )
+                    restore_ops.append(variable.assign(value))
+                    restore_feed_dict[value] = data_to_load["weights"][variable.name]
                 else:
                     print(
                         "Freshly initializing %s since no saved value was found."
@@ -707,7 +602,7 @@ class ChemModel(object):
                 if var_name not in used_vars:
                     print("Saved weights for %s not used by model." % var_name)
             restore_ops.append(tf.variables_initializer(variables_to_initialize))
-            self.sess.run(restore_ops)
+            self.sess.run(tf.group(*restore_ops), feed_dict=restore_feed_dict)
 
     def get_time_diff(self, t_new, t_old):
         diff = t_new - t_old
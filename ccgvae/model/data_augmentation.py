@@ -20,11 +20,12 @@ def generate_mask(
 ):
     edge_type_mask = []
     edge_mask = []
+    focus_adjacent = adjacent_edge_types(adj_mat, node_in_focus)
     for neighbor in range(real_n_vertices):
         if (
             neighbor != node_in_focus
             and color[neighbor] < 2
-            and not check_adjacent_sparse(adj_mat, node_in_focus, neighbor)[0]
+            and neighbor not in focus_adjacent
         ):
             min_valence = min(valences[node_in_focus], valences[neighbor], 3)
             # Check whether two cycles have more than two overlap edges here
@@ -65,13 +66,12 @@ def generate_label(
 ):
     edge_type_label = []
     edge_label = []
+    focus_adjacent = adjacent_edge_types(ground_truth_graph, node_in_focus)
+    incre_focus_adjacent = adjacent_edge_types(incremental_adj, node_in_focus)
     for neighbor in range(real_n_vertices):
-        adjacent, edge_type = check_adjacent_sparse(
-            ground_truth_graph, node_in_focus, neighbor
-        )
-        incre_adjacent, incre_edge_type = check_adjacent_sparse(
-            incremental_adj, node_in_focus, neighbor
-        )
+        adjacent = neighbor in focus_adjacent
+        edge_type = focus_adjacent.get(neighbor)
+        incre_adjacent = neighbor in incre_focus_adjacent
         if not params["label_one_hot"] and adjacent and not incre_adjacent:
             assert edge_type < 3
             edge_type_label.append((node_in_focus, neighbor, edge_type))
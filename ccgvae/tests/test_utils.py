@@ -0,0 +1,69 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path = [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] + sys.path
+
+import CCGVAE  # noqa: E402
+from utils import utils  # noqa: E402
+
+
+class TestDumpJson(unittest.TestCase):
+    def setUp(self):
+        # default_params reads the dataset global that CCGVAE.py's main sets
+        CCGVAE.dataset = "zinc"
+        self.params = CCGVAE.CCGVAE.default_params()
+
+    def test_dump_default_params(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "params.json")
+            utils.dump_json(self.params, path)
+            with open(path) as f:
+                dumped = json.load(f)
+        self.assertEqual(dumped, json.loads(json.dumps(self.params)))
+
+    def test_append_default_params(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "log.jsonl")
+            utils.append_json_line(self.params, path)
+            utils.append_json_line(self.params, path)
+            with open(path) as f:
+                lines = [json.loads(line) for line in f]
+        self.assertEqual(lines, [json.loads(json.dumps(self.params))] * 2)
+
+
+class TestLoadJsonCached(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "data.json")
+        self.cache_dir = os.path.join(self.directory.name, ".cache")
+        self.write([{"smiles": "CCO"}], mtime=1)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, data, mtime):
+        with open(self.path, "w") as f:
+            json.dump(data, f)
+        os.utime(self.path, (mtime, mtime))
+
+    def test_rebuilt_after_change(self):
+        utils.load_json_cached(self.path, self.cache_dir)
+        self.write([{"smiles": "CCN"}], mtime=2)
+        data = utils.load_json_cached(self.path, self.cache_dir)
+        self.assertEqual(data, [{"smiles": "CCN"}])
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+    def test_torn_entry_is_a_miss(self):
+        utils.load_json_cached(self.path, self.cache_dir)
+        (entry,) = os.listdir(self.cache_dir)
+        with open(os.path.join(self.cache_dir, entry), "r+b") as f:
+            f.truncate(12)
+        data = utils.load_json_cached(self.path, self.cache_dir)
+        self.assertEqual(data, [{"smiles": "CCO"}])
+
+
+if __name__ == "__main__":
+    unittest.main()
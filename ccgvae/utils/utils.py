@@ -1,8 +1,13 @@
 #!/usr/bin/env/python
+import hashlib
+import json
+import os
 import pickle
 import queue
+import tempfile
 import threading
 from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from threading import Thread
 
 from functools import lru_cache
@@ -11,6 +16,11 @@ import tensorflow as tf
 from rdkit import Chem
 from rdkit.Chem import rdmolops
 
+try:
+    import orjson
+except ImportError:  # orjson needs Python >= 3.6
+    orjson = None
+
 SMALL_NUMBER = 1e-7
 LARGE_NUMBER = 1e10
 
@@ -26,37 +36,52 @@ number_to_bond = {
 }
 
 
+def read_smiles_file(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
 def read_our_data(path):
-    smiles_train = [line.strip() for line in open(path + "/train.smi") if line.strip()]
-    smiles_valid = [line.strip() for line in open(path + "/valid.smi") if line.strip()]
-    smiles_test = [line.strip() for line in open(path + "/test.smi") if line.strip()]
     return {
-        "train": smiles_train,
-        "valid": smiles_valid,
-        "test": smiles_test,
+        "train": read_smiles_file(path + "/train.smi"),
+        "valid": read_smiles_file(path + "/valid.smi"),
+        "test": read_smiles_file(path + "/test.smi"),
     }
 
 
-def build_dataset_info(data, size):
+# maximum valence of each "<symbol><valence>(<charge>)" atom type found in smiles_list
+def atom_types_maximum_valence(smiles_list):
+    atom_to_maximum_valence = {}
+    for smiles in smiles_list:
+        mol = Chem.MolFromSmiles(smiles)
+        for atom in mol.GetAtoms():
+            valence = atom.GetTotalValence()
+            symbol = atom.GetSymbol()
+            charge = atom.GetFormalCharge()
+            atom_str = "%s%i(%i)" % (symbol, valence, charge)
+            atom_to_maximum_valence[atom_str] = max(
+                atom_to_maximum_valence.get(atom_str, 0), valence
+            )
+    return atom_to_maximum_valence
+
+
+def build_dataset_info(data, size, chunk_size=4096):
     size = int(size)
-    atom_types = set()
     atom_to_maximum_valence = {}
 
-    for split, split_smiles in data.items():
-        for i, smiles in enumerate(split_smiles):
-            mol = Chem.MolFromSmiles(smiles)
-            atoms = mol.GetAtoms()
-            for atom in atoms:
-                valence = atom.GetTotalValence()
-                symbol = atom.GetSymbol()
-                charge = atom.GetFormalCharge()
-                atom_str = "%s%i(%i)" % (symbol, valence, charge)
-                atom_types.add(atom_str)
+    # parse the molecules in chunks on all the cores, then merge the per-chunk maxima
+    all_smiles = [smiles for split_smiles in data.values() for smiles in split_smiles]
+    chunks = [
+        all_smiles[i : i + chunk_size] for i in range(0, len(all_smiles), chunk_size)
+    ]
+    with ProcessPoolExecutor() as executor:
+        for chunk_maximum_valence in executor.map(atom_types_maximum_valence, chunks):
+            for atom_str, valence in chunk_maximum_valence.items():
                 atom_to_maximum_valence[atom_str] = max(
                     atom_to_maximum_valence.get(atom_str, 0), valence
                 )
 
-    atom_types = sorted(atom_types)
+    atom_types = sorted(atom_to_maximum_valence)
     number_to_atom = {
         i: atom[0] for i, atom in enumerate(atom_types)
     }  # [0] to test number_to_symbol
@@ -79,6 +104,69 @@ def build_dataset_info(data, size):
     return info
 
 
+def load_json(path):
+    if orjson is not None:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def dump_json(obj, path, indent=False):
+    if orjson is not None:
+        # Non-str keys (e.g. the int layers of residual_connections) are allowed by json too
+        option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(obj, option=option))
+    else:
+        with open(path, "w") as f:
+            json.dump(obj, f, indent=2 if indent else None)
+
+
+def append_json_line(obj, path):
+    """Append `obj` as one line to the JSON-lines file at `path`."""
+    if orjson is not None:
+        with open(path, "ab") as f:
+            option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+            f.write(orjson.dumps(obj, option=option) + b"\n")
+    else:
+        with open(path, "a") as f:
+            f.write(json.dumps(obj) + "\n")
+
+
+def load_json_cached(path, cache_dir):
+    """Load a JSON file, keeping a pickled copy keyed by its path in `cache_dir`.
+
+    The mtime of the JSON file is stored with the copy, which is rebuilt once
+    it changes. A missing or torn copy is treated as a cache miss.
+    """
+    key = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+    cache_path = os.path.join(cache_dir, key + ".pickle")
+    mtime = os.path.getmtime(path)
+    try:
+        with open(cache_path, "rb") as f:
+            if pickle.load(f) == mtime:
+                return pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        pass
+
+    data = load_json(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write next to the target and rename over it, so concurrent runs never read a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(mtime, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return data
+
+
 @lru_cache(maxsize=3)
 def dataset_info(dataset):
     if "size_" in dataset:
@@ -198,20 +286,24 @@ def add_edge_mat(amat, src, dest, e, considering_edge_type=True):
 
 
 def graph_to_adj_mat(graph, max_n_vertices, num_edge_types, considering_edge_type=True):
+    # set all the edges with one scatter instead of calling add_edge_mat per edge
+    src, e, dest = np.asarray(graph, dtype=np.intp).reshape(-1, 3).T
     if considering_edge_type:
-        amat = np.zeros((num_edge_types, max_n_vertices, max_n_vertices))
-        for src, e, dest in graph:
-            add_edge_mat(amat, src, dest, e)
+        amat = np.zeros(
+            (num_edge_types, max_n_vertices, max_n_vertices), dtype=np.float32
+        )
+        amat[e, dest, src] = 1
+        amat[e, src, dest] = 1
     else:
-        amat = np.zeros((max_n_vertices, max_n_vertices))
-        for src, e, dest in graph:
-            add_edge_mat(amat, src, dest, e, considering_edge_type=False)
+        amat = np.zeros((max_n_vertices, max_n_vertices), dtype=np.float32)
+        amat[src, dest] = 1
+        amat[dest, src] = 1
     return amat
 
 
 # generates one hot vector
 def onehot(idx, len):
-    z = [0 for _ in range(len)]
+    z = [0] * len
     z[idx] = 1
     return z
 
@@ -223,28 +315,26 @@ def generate_std_normal(a1, a2, a3):
 
 # Get length for each graph based on node masks
 def get_graph_length(all_node_mask):
-    all_lengths = []
-    for graph in all_node_mask:
-        if 0 in graph:
-            length = np.argmin(graph)
-        else:
-            length = len(graph)
-        all_lengths.append(length)
-    return all_lengths
+    all_node_mask = np.asarray(all_node_mask)
+    # index of the first 0 in each mask, or the full length if there is none
+    has_padding = (all_node_mask == 0).any(axis=1)
+    all_lengths = np.where(
+        has_padding, all_node_mask.argmin(axis=1), all_node_mask.shape[1]
+    )
+    return all_lengths.tolist()
 
 
 # sample node symbols based on node predictions
 def sample_node_symbol(all_node_symbol_prob, all_lengths, dataset):
+    num_atom_types = len(dataset_info(dataset)["atom_types"])
     all_node_symbol = []
     for graph_idx, graph_prob in enumerate(all_node_symbol_prob):
-        node_symbol = []
-        for node_idx in range(all_lengths[graph_idx]):
-            symbol = np.random.choice(
-                np.arange(len(dataset_info(dataset)["atom_types"])),
-                p=graph_prob[node_idx],
-            )
-            node_symbol.append(symbol)
-        all_node_symbol.append(node_symbol)
+        # inverse transform sampling of all the nodes at once: count the cdf entries below a uniform draw
+        probs = np.asarray(graph_prob[: all_lengths[graph_idx]], dtype=np.float64)
+        cdf = np.cumsum(probs.reshape(-1, num_atom_types), axis=1)
+        u = np.random.random(len(cdf))
+        node_symbol = np.minimum((cdf < u[:, None]).sum(axis=1), num_atom_types - 1)
+        all_node_symbol.append(node_symbol.tolist())
     return all_node_symbol
 
 
@@ -254,9 +344,7 @@ def sample_argmax_node_symbol(all_node_symbol_prob, all_lengths, dataset):
     for graph_idx, graph_prob in enumerate(all_node_symbol_prob):
         node_symbol = []
         for node_idx in range(all_lengths[graph_idx]):
-            symbol = np.arange(len(dataset_info(dataset)["atom_types"]))[
-                np.argmax(graph_prob[node_idx])
-            ]
+            symbol = int(np.argmax(graph_prob[node_idx]))
             node_symbol.append(symbol)
         all_node_symbol.append(node_symbol)
     return all_node_symbol
@@ -274,11 +362,13 @@ def get_overlapped_edge_feature(edge_mask, color, new_mol):
                 ssr = Chem.GetSymmSSSR(new_mol)  # smallest set of smallest rings
             except:
                 ssr = []
-            overlap_flag = False
-            for idx1 in range(len(ssr)):
-                for idx2 in range(idx1 + 1, len(ssr)):
-                    if len(set(ssr[idx1]) & set(ssr[idx2])) > 2:
-                        overlap_flag = True
+            # each ring converted to a set once, stop at the first overlapping pair
+            rings = [set(ring) for ring in ssr]
+            overlap_flag = any(
+                len(rings[idx1] & rings[idx2]) > 2
+                for idx1 in range(len(rings))
+                for idx2 in range(idx1 + 1, len(rings))
+            )
             # remove that edge
             new_mol.RemoveBond(int(node_in_focus), int(neighbor))
             if overlap_flag:
@@ -288,67 +378,75 @@ def get_overlapped_edge_feature(edge_mask, color, new_mol):
 
 # adj_list [3, v, v] or defaultdict. bfs distance on a graph
 def bfs_distance(start, adj_list, is_dense=False):
-    distances = {}
-    visited = set()
-    queue = deque([(start, 0)])
-    visited.add(start)
-    while len(queue) != 0:
-        current, d = queue.popleft()
-        for neighbor, edge_type in adj_list[current]:
-            if neighbor not in visited:
-                distances[neighbor] = d + 1
-                visited.add(neighbor)
-                queue.append((neighbor, d + 1))
+    # level by level, the distances dict doubles as the visited set
+    distances = {start: 0}
+    frontier = [start]
+    d = 0
+    while frontier:
+        d += 1
+        next_frontier = []
+        for current in frontier:
+            for neighbor, edge_type in adj_list[current]:
+                if neighbor not in distances:
+                    distances[neighbor] = d
+                    next_frontier.append(neighbor)
+        frontier = next_frontier
+    del distances[start]
     return [(start, node, d) for node, d in distances.items()]
 
 
 def get_initial_valence(node_symbol, dataset):
-    return [dataset_info(dataset)["maximum_valence"][s] for s in node_symbol]
+    maximum_valence = dataset_info(dataset)["maximum_valence"]
+    return [maximum_valence[s] for s in node_symbol]
 
 
 def add_atoms(new_mol, node_symbol, dataset):
+    info = dataset_info(dataset)
     for number in node_symbol:
         if dataset == "qm9" or dataset == "cep":
-            idx = new_mol.AddAtom(
-                Chem.Atom(dataset_info(dataset)["number_to_atom"][number])
-            )
+            idx = new_mol.AddAtom(Chem.Atom(info["number_to_atom"][number]))
         elif dataset == "zinc" or "size_" in dataset:
-            new_atom = Chem.Atom(dataset_info(dataset)["number_to_atom"][number])
-            charge_num = int(
-                dataset_info(dataset)["atom_types"][number].split("(")[1].strip(")")
-            )
+            new_atom = Chem.Atom(info["number_to_atom"][number])
+            charge_num = int(info["atom_types"][number].split("(")[1].strip(")"))
             new_atom.SetFormalCharge(charge_num)
             new_mol.AddAtom(new_atom)
 
 
 def get_idx_of_largest_frag(frags):
-    return np.argmax([len(frag) for frag in frags])
+    return max(range(len(frags)), key=lambda idx: len(frags[idx]))
 
 
 def remove_extra_nodes(new_mol):
     frags = Chem.rdmolops.GetMolFrags(new_mol)
-    while len(frags) > 1:
-        # Get the idx of the frag with largest length
-        largest_idx = get_idx_of_largest_frag(frags)
-        for idx in range(len(frags)):
-            if idx != largest_idx:
-                # Remove one atom that is not in the largest frag
-                new_mol.RemoveAtom(frags[idx][0])
-                break
-        frags = Chem.rdmolops.GetMolFrags(new_mol)
+    if len(frags) <= 1:
+        return
+    # Get the idx of the frag with largest length
+    largest_idx = get_idx_of_largest_frag(frags)
+    # Remove every atom that is not in the largest frag, highest index first since removing re-indexes the later atoms
+    atoms_to_remove = sorted(
+        (atom for idx, frag in enumerate(frags) if idx != largest_idx for atom in frag),
+        reverse=True,
+    )
+    for atom in atoms_to_remove:
+        new_mol.RemoveAtom(atom)
 
 
 def need_kekulize(mol):
-    for bond in mol.GetBonds():
-        if bond_dict[str(bond.GetBondType())] >= 3:
-            return True
-    return False
+    # aromatic is the only bond type past triple in bond_dict
+    return any(
+        bond.GetBondType() == Chem.rdchem.BondType.AROMATIC for bond in mol.GetBonds()
+    )
 
 
 def to_graph(smiles, dataset):
     mol = Chem.MolFromSmiles(smiles)
     if mol is None:
         return [], []
+    return mol_to_graph(mol, dataset)
+
+
+# same as to_graph for an already parsed molecule, which gets kekulized and loses its stereo information
+def mol_to_graph(mol, dataset):
     # Kekulize it
     if need_kekulize(mol):
         rdmolops.Kekulize(mol)
@@ -357,6 +455,8 @@ def to_graph(smiles, dataset):
     # remove stereo information, such as inward and outward edges
     Chem.RemoveStereochemistry(mol)
 
+    atom_types = dataset_info(dataset)["atom_types"]
+    atom_type_idx = {atom_type: idx for idx, atom_type in enumerate(atom_types)}
     edges = []
     nodes = []
     for bond in mol.GetBonds():
@@ -367,31 +467,20 @@ def to_graph(smiles, dataset):
                 bond.GetEndAtomIdx(),
             )
         )
-        assert bond_dict[str(bond.GetBondType())] != 3
     for atom in mol.GetAtoms():
         if dataset == "qm9":
-            nodes.append(
-                onehot(
-                    dataset_info(dataset)["atom_types"].index(atom.GetSymbol()),
-                    len(dataset_info(dataset)["atom_types"]),
-                )
-            )
+            nodes.append(onehot(atom_type_idx[atom.GetSymbol()], len(atom_types)))
         else:  # transform using "<atom_symbol><valence>(<charge>)"  notation
             symbol = atom.GetSymbol()
             valence = atom.GetTotalValence()
             charge = atom.GetFormalCharge()
             atom_str = "%s%i(%i)" % (symbol, valence, charge)
 
-            if atom_str not in dataset_info(dataset)["atom_types"]:
+            if atom_str not in atom_type_idx:
                 print("Unrecognized atom type %s" % atom_str)
                 return [], []
 
-            nodes.append(
-                onehot(
-                    dataset_info(dataset)["atom_types"].index(atom_str),
-                    len(dataset_info(dataset)["atom_types"]),
-                )
-            )
+            nodes.append(onehot(atom_type_idx[atom_str], len(atom_types)))
 
     return nodes, edges
 
@@ -404,15 +493,18 @@ def shape_count(dataset, remove_print=False, all_smiles=None):
     geometry_counts = [0] * len(geometry_numbers)
     geometry_counts_per_molecule = []  # record the geometry counts for each molecule
     for smiles in all_smiles:
-        nodes, edges = to_graph(smiles, dataset)
+        # parse once, the rings are taken before mol_to_graph modifies the molecule
+        new_mol = Chem.MolFromSmiles(smiles)
+        if new_mol is None:
+            continue
+        ssr = Chem.GetSymmSSSR(new_mol)
+        nodes, edges = mol_to_graph(new_mol, dataset)
         if len(edges) <= 0:
             continue
-        new_mol = Chem.MolFromSmiles(smiles)
 
-        ssr = Chem.GetSymmSSSR(new_mol)
         counts_for_molecule = [0] * len(geometry_numbers)
         for idx in range(len(ssr)):
-            ring_len = len(list(ssr[idx]))
+            ring_len = len(ssr[idx])
             if ring_len in geometry_numbers:
                 geometry_counts[geometry_numbers.index(ring_len)] += 1
                 counts_for_molecule[geometry_numbers.index(ring_len)] += 1
@@ -428,6 +520,12 @@ def check_adjacent_sparse(adj_list, node, neighbor_in_doubt):
     return False, None
 
 
+# neighbor -> edge type for all the neighbors of node, to check many neighbors of the same node in O(1) each
+def adjacent_edge_types(adj_list, node):
+    # reversed so that, like check_adjacent_sparse, the first listed edge wins
+    return {neighbor: edge_type for neighbor, edge_type in reversed(adj_list[node])}
+
+
 def glorot_init(shape):
     initialization_range = np.sqrt(6.0 / (shape[-2] + shape[-1]))
     return np.random.uniform(
@@ -437,11 +535,16 @@ def glorot_init(shape):
 
 class ThreadedIterator:
     """An iterator object that computes its elements in a parallel thread to be ready to be consumed.
-    The iterator should *not* return None"""
+    The iterator should *not* return None.
+    A thread and not a process: the elements are feed dicts keyed by TF placeholders, which cannot be
+    pickled, and the consumer spends its time in sess.run, which releases the GIL."""
 
     def __init__(self, original_iterator, max_queue_size: int = 2):
         self.__queue = queue.Queue(maxsize=max_queue_size)
-        self.__thread = threading.Thread(target=lambda: self.worker(original_iterator))
+        # daemon, so a consumer that stops early does not leave the process waiting on a blocked put
+        self.__thread = threading.Thread(
+            target=lambda: self.worker(original_iterator), daemon=True
+        )
         self.__thread.start()
 
     def worker(self, original_iterator):
@@ -472,12 +575,14 @@ class MLP(object):
     def make_network_params(self):
         dims = [self.in_size] + self.hid_sizes + [self.out_size]
         weight_sizes = list(zip(dims[:-1], dims[1:]))
+        # initialized in the graph, no NumPy array to build and copy in per layer
+        init_weights = tf.glorot_uniform_initializer()
         weights = [
-            tf.Variable(self.init_weights(s), name="MLP_W_layer%i" % i)
+            tf.Variable(init_weights(s, dtype=tf.float32), name="MLP_W_layer%i" % i)
             for (i, s) in enumerate(weight_sizes)
         ]
         biases = [
-            tf.Variable(np.zeros(s[-1]).astype(np.float32), name="MLP_b_layer%i" % i)
+            tf.Variable(tf.zeros(s[-1], dtype=tf.float32), name="MLP_b_layer%i" % i)
             for (i, s) in enumerate(weight_sizes)
         ]
 
@@ -488,18 +593,17 @@ class MLP(object):
 
         return network_params
 
-    def init_weights(self, shape):
-        return np.sqrt(6.0 / (shape[-2] + shape[-1])) * (
-            2 * np.random.rand(*shape).astype(np.float32) - 1
-        )
-
     def __call__(self, inputs):
         acts = inputs
-        for W, b in zip(self.params["weights"], self.params["biases"]):
-            hid = tf.matmul(acts, tf.nn.dropout(W, self.dropout_keep_prob)) + b
-            acts = tf.nn.relu(hid)
-        last_hidden = hid
-        return last_hidden
+        layers = list(zip(self.params["weights"], self.params["biases"]))
+        for i, (W, b) in enumerate(layers):
+            hid = tf.nn.bias_add(
+                tf.matmul(acts, tf.nn.dropout(W, self.dropout_keep_prob)), b
+            )
+            # the last layer is returned before the non-linearity
+            if i < len(layers) - 1:
+                acts = tf.nn.relu(hid)
+        return hid
 
 
 class Graph:
@@ -513,29 +617,28 @@ class Graph:
         # Add v to w list.
         self.graph[w].append(v)
 
-        # A recursive function that uses visited[]
-
-    # and parent to detect cycle in subgraph
-    # reachable from vertex v.
+    # Uses visited[] and the parent of each vertex to detect
+    # a cycle in the subgraph reachable from vertex v.
+    # Iterative DFS, so deep graphs do not hit the recursion limit.
     def isCyclicUtil(self, v, visited, parent):
-        # Mark current node as visited
+        # Mark the start vertex as visited
         visited[v] = True
-
-        # Recur for all the vertices adjacent
-        # for this vertex
-        for i in self.graph[v]:
-            # If an adjacent is not visited,
-            # then recur for that adjacent
-            if visited[i] == False:
-                if self.isCyclicUtil(i, visited, v) == True:
+        stack = [(v, parent)]
+        while stack:
+            v, parent = stack.pop()
+            for i in self.graph[v]:
+                # If an adjacent is not visited,
+                # then visit it later with v as its parent
+                if not visited[i]:
+                    visited[i] = True
+                    stack.append((i, v))
+
+                # If an adjacent is visited and not
+                # parent of current vertex, then there
+                # is a cycle.
+                elif i != parent:
                     return True
 
-            # If an adjacent is visited and not
-            # parent of current vertex, then there
-            # is a cycle.
-            elif i != parent:
-                return True
-
         return False
 
     # Returns true if the graph is a tree,
@@ -564,97 +667,135 @@ class Graph:
 
 # select the best based on shapes and probs
 def select_best(all_mol):
-    extracted = []
-    for i in range(len(all_mol)):
-        extracted.append((all_mol[i][0], all_mol[i][1], i))
-
-    extracted = sorted(extracted)
-    return all_mol[extracted[-1][2]][2]
+    # the index in the key keeps the last molecule on ties, as the sort used to
+    best_idx = max(
+        range(len(all_mol)), key=lambda i: (all_mol[i][0], all_mol[i][1], i)
+    )
+    return all_mol[best_idx][2]
 
 
 # a series util function converting sparse matrix representation to dense
-def incre_adj_mat_to_dense(incre_adj_mat, num_edge_types, maximum_vertice_num):
-    new_incre_adj_mat = []
-    for sparse_incre_adj_mat in incre_adj_mat:
-        dense_incre_adj_mat = np.zeros(
-            (num_edge_types, maximum_vertice_num, maximum_vertice_num)
-        )
-        for current, adj_list in sparse_incre_adj_mat.items():
-            for neighbor, edge_type in adj_list:
-                dense_incre_adj_mat[edge_type][current][neighbor] = 1
-        new_incre_adj_mat.append(dense_incre_adj_mat)
-    return new_incre_adj_mat  # [number_iteration,num_edge_types,maximum_vertice_num, maximum_vertice_num]
-
-
-def distance_to_others_dense(distance_to_others, maximum_vertice_num):
-    new_all_distance = []
-    for sparse_distances in distance_to_others:
-        dense_distances = np.zeros((maximum_vertice_num), dtype=int)
+# dense array of `shape` with `values` written at the given index tuples, everything else zero
+def scatter_to_dense(shape, indices, values=1, dtype=np.float32):
+    dense = np.zeros(shape, dtype=dtype)
+    if len(indices) > 0:
+        dense[tuple(np.array(indices, dtype=np.intp).T)] = values
+    return dense
+
+
+# The *_to_dense functions return one row per iteration, zero padded up to num_iterations rows
+def incre_adj_mat_to_dense(
+    incre_adj_mat, num_edge_types, maximum_vertice_num, num_iterations=None
+):
+    if num_iterations is None:
+        num_iterations = len(incre_adj_mat)
+    indices = [
+        (t, edge_type, current, neighbor)
+        for t, sparse_incre_adj_mat in enumerate(incre_adj_mat)
+        for current, adj_list in sparse_incre_adj_mat.items()
+        for neighbor, edge_type in adj_list
+    ]
+    return scatter_to_dense(
+        (num_iterations, num_edge_types, maximum_vertice_num, maximum_vertice_num),
+        indices,
+    )  # [number_iteration,num_edge_types,maximum_vertice_num, maximum_vertice_num]
+
+
+def distance_to_others_dense(
+    distance_to_others, maximum_vertice_num, num_iterations=None
+):
+    if num_iterations is None:
+        num_iterations = len(distance_to_others)
+    indices = []
+    distances = []
+    for t, sparse_distances in enumerate(distance_to_others):
         for x, y, d in sparse_distances:
-            dense_distances[y] = d
-        new_all_distance.append(dense_distances)
-    return new_all_distance  # [number_iteration, maximum_vertice_num]
-
-
-def overlapped_edge_features_to_dense(overlapped_edge_features, maximum_vertice_num):
-    new_overlapped_edge_features = []
-    for sparse_overlapped_edge_features in overlapped_edge_features:
-        dense_overlapped_edge_features = np.zeros((maximum_vertice_num), dtype=int)
-        for node_in_focus, neighbor in sparse_overlapped_edge_features:
-            dense_overlapped_edge_features[neighbor] = 1
-        new_overlapped_edge_features.append(dense_overlapped_edge_features)
-    return new_overlapped_edge_features  # [number_iteration, maximum_vertice_num]
-
-
-def node_sequence_to_dense(node_sequence, maximum_vertice_num):
-    new_node_sequence = []
-    for node in node_sequence:
-        s = [0] * maximum_vertice_num
-        s[node] = 1
-        new_node_sequence.append(s)
-    return new_node_sequence  # [number_iteration, maximum_vertice_num]
-
-
-def edge_type_masks_to_dense(edge_type_masks, maximum_vertice_num, num_edge_types):
-    new_edge_type_masks = []
-    for mask_sparse in edge_type_masks:
-        mask_dense = np.zeros([num_edge_types, maximum_vertice_num])
-        for node_in_focus, neighbor, bond in mask_sparse:
-            mask_dense[bond][neighbor] = 1
-        new_edge_type_masks.append(mask_dense)
-    return new_edge_type_masks  # [number_iteration, 3, maximum_vertice_num]
-
-
-def edge_type_labels_to_dense(edge_type_labels, maximum_vertice_num, num_edge_types):
-    new_edge_type_labels = []
-    for labels_sparse in edge_type_labels:
-        labels_dense = np.zeros([num_edge_types, maximum_vertice_num])
+            indices.append((t, y))
+            distances.append(d)
+    return scatter_to_dense(
+        (num_iterations, maximum_vertice_num), indices, distances, dtype=np.int32
+    )  # [number_iteration, maximum_vertice_num]
+
+
+def overlapped_edge_features_to_dense(
+    overlapped_edge_features, maximum_vertice_num, num_iterations=None
+):
+    if num_iterations is None:
+        num_iterations = len(overlapped_edge_features)
+    indices = [
+        (t, neighbor)
+        for t, sparse_overlapped_edge_features in enumerate(overlapped_edge_features)
+        for node_in_focus, neighbor in sparse_overlapped_edge_features
+    ]
+    return scatter_to_dense(
+        (num_iterations, maximum_vertice_num), indices, dtype=np.int32
+    )  # [number_iteration, maximum_vertice_num]
+
+
+def node_sequence_to_dense(node_sequence, maximum_vertice_num, num_iterations=None):
+    if num_iterations is None:
+        num_iterations = len(node_sequence)
+    return scatter_to_dense(
+        (num_iterations, maximum_vertice_num), list(enumerate(node_sequence))
+    )  # [number_iteration, maximum_vertice_num]
+
+
+def edge_type_masks_to_dense(
+    edge_type_masks, maximum_vertice_num, num_edge_types, num_iterations=None
+):
+    if num_iterations is None:
+        num_iterations = len(edge_type_masks)
+    indices = [
+        (t, bond, neighbor)
+        for t, mask_sparse in enumerate(edge_type_masks)
+        for node_in_focus, neighbor, bond in mask_sparse
+    ]
+    return scatter_to_dense(
+        (num_iterations, num_edge_types, maximum_vertice_num), indices
+    )  # [number_iteration, 3, maximum_vertice_num]
+
+
+def edge_type_labels_to_dense(
+    edge_type_labels, maximum_vertice_num, num_edge_types, num_iterations=None
+):
+    if num_iterations is None:
+        num_iterations = len(edge_type_labels)
+    indices = []
+    probs = []
+    for t, labels_sparse in enumerate(edge_type_labels):
         for node_in_focus, neighbor, bond in labels_sparse:
-            labels_dense[bond][neighbor] = 1 / float(
-                len(labels_sparse)
-            )  # fix the probability bug here.
-        new_edge_type_labels.append(labels_dense)
-    return new_edge_type_labels  # [number_iteration, 3, maximum_vertice_num]
-
-
-def edge_masks_to_dense(edge_masks, maximum_vertice_num):
-    new_edge_masks = []
-    for mask_sparse in edge_masks:
-        mask_dense = [0] * maximum_vertice_num
-        for node_in_focus, neighbor in mask_sparse:
-            mask_dense[neighbor] = 1
-        new_edge_masks.append(mask_dense)
-    return new_edge_masks  # [number_iteration, maximum_vertice_num]
-
-
-def edge_labels_to_dense(edge_labels, maximum_vertice_num):
-    new_edge_labels = []
-    for label_sparse in edge_labels:
-        label_dense = [0] * maximum_vertice_num
+            indices.append((t, bond, neighbor))
+            probs.append(1 / float(len(labels_sparse)))  # fix the probability bug here.
+    return scatter_to_dense(
+        (num_iterations, num_edge_types, maximum_vertice_num), indices, probs
+    )  # [number_iteration, 3, maximum_vertice_num]
+
+
+def edge_masks_to_dense(edge_masks, maximum_vertice_num, num_iterations=None):
+    if num_iterations is None:
+        num_iterations = len(edge_masks)
+    indices = [
+        (t, neighbor)
+        for t, mask_sparse in enumerate(edge_masks)
+        for node_in_focus, neighbor in mask_sparse
+    ]
+    return scatter_to_dense(
+        (num_iterations, maximum_vertice_num), indices
+    )  # [number_iteration, maximum_vertice_num]
+
+
+def edge_labels_to_dense(edge_labels, maximum_vertice_num, num_iterations=None):
+    if num_iterations is None:
+        num_iterations = len(edge_labels)
+    indices = []
+    probs = []
+    for t, label_sparse in enumerate(edge_labels):
         for node_in_focus, neighbor in label_sparse:
-            label_dense[neighbor] = 1 / float(len(label_sparse))
-        new_edge_labels.append(label_dense)
-    return new_edge_labels  # [number_iteration, maximum_vertice_num]
+            indices.append((t, neighbor))
+            probs.append(1 / float(len(label_sparse)))
+    return scatter_to_dense(
+        (num_iterations, maximum_vertice_num), indices, probs
+    )  # [number_iteration, maximum_vertice_num]
 
 
 class ThreadWithReturnValue(object):
@@ -10,7 +10,10 @@ class Agent(nn.Module):
         self.affine1 = nn.Linear(feat_dim + 2, hidden_size)
         self.dropout = nn.Dropout(p=0.5)
         self.affine2 = nn.Linear(hidden_size, 2)
-        self.saved_log_probs = {}
+        # Parallel lists, one entry per action taken: its log-prob and where it happened
+        self.saved_log_probs = []
+        self.saved_sample_numbers = []
+        self.saved_iter_nums = []
 
     def forward(self, x):
         x = self.affine1(x)
@@ -18,6 +21,11 @@ class Agent(nn.Module):
         scores = self.affine2(x)
         return F.softmax(scores, dim=1)
 
+    def clear_saved_actions(self):
+        self.saved_log_probs.clear()
+        self.saved_sample_numbers.clear()
+        self.saved_iter_nums.clear()
+
 
 def sample(agent, subgraph_feature, iter_num, sample_number):
     # subgraph_feature: N * (2+feat_dim), N is the number of subgraphs inside all inputs
@@ -26,11 +34,8 @@ def sample(agent, subgraph_feature, iter_num, sample_number):
     a = m.sample()
     take_action = (np.sum(a.numpy()) != 0)
     if take_action:
-        if sample_number not in agent.saved_log_probs.keys():
-            agent.saved_log_probs[sample_number] = {}
-        if iter_num not in agent.saved_log_probs[sample_number].keys():
-            agent.saved_log_probs[sample_number][iter_num] = [m.log_prob(a)]
-        else:
-            agent.saved_log_probs[sample_number][iter_num].append(m.log_prob(a))
+        agent.saved_log_probs.append(m.log_prob(a))
+        agent.saved_sample_numbers.append(sample_number)
+        agent.saved_iter_nums.append(iter_num)
     return a.numpy(), take_action
     
@@ -1,5 +1,4 @@
 from rdkit import Chem
-from copy import deepcopy
 import numpy as np
 from private import *
 from grammar_generation import *
@@ -15,12 +14,15 @@ import pprint
 import pickle
 import argparse
 import fcntl
+import io
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from retro_star_listener import lock
+from retro_star_listener import lock, wait_for_update
 
 GENERATED_SO_FAR = 0
 SAVE_FILE_IN_TRAINING = "generated_samples.in-training.txt"
 SAVE_FILE_THE_END = "generated_samples.the-end.txt"
+MOLECULE_WRITE_BATCH = 64
 
 
 def evaluate(grammar, args, metrics=["diversity", "syn"], to_generate: int = -1):
@@ -30,35 +32,47 @@ def evaluate(grammar, args, metrics=["diversity", "syn"], to_generate: int = -1)
     eval_metrics = {}
     generated_samples = []
     generated_samples_canonical_sml = []
+    generated_samples_canonical_sml_set = set()  # O(1) duplicate check
     iter_num_list = []
     idx = 0
     no_newly_generated_iter = 0
     print("Start grammar evaluation...")
     save_file = SAVE_FILE_IN_TRAINING if to_generate == -1 else SAVE_FILE_THE_END
+    molecule_buffer = []
     with open(f"{args.output_dir}/{save_file}", "a") as molecule_file:
-        while True:
-            print("Generating sample {}/{}".format(idx, args.num_generated_samples))
-            mol, iter_num = random_produce(grammar)
-            GENERATED_SO_FAR += 1
-            if mol is None:
-                no_newly_generated_iter += 1
-                continue
-            can_sml_mol = Chem.CanonSmiles(Chem.MolToSmiles(mol))
-            molecule_file.write(f"{can_sml_mol}\n")
-            if can_sml_mol not in generated_samples_canonical_sml:
-                generated_samples.append(mol)
-                generated_samples_canonical_sml.append(can_sml_mol)
-                iter_num_list.append(iter_num)
-                idx += 1
-                no_newly_generated_iter = 0
-            else:
-                no_newly_generated_iter += 1
-            if (
-                idx
-                >= (args.num_generated_samples if to_generate == -1 else to_generate)
-                or no_newly_generated_iter > 10
-            ):
-                break
+        try:
+            while True:
+                print(
+                    "Generating sample {}/{}".format(idx, args.num_generated_samples)
+                )
+                mol, iter_num = random_produce(grammar)
+                GENERATED_SO_FAR += 1
+                if mol is None:
+                    no_newly_generated_iter += 1
+                    continue
+                can_sml_mol = Chem.MolToSmiles(mol, canonical=True)
+                molecule_buffer.append(f"{can_sml_mol}\n")
+                if len(molecule_buffer) >= MOLECULE_WRITE_BATCH:
+                    molecule_file.writelines(molecule_buffer)
+                    molecule_buffer.clear()
+                if can_sml_mol not in generated_samples_canonical_sml_set:
+                    generated_samples.append(mol)
+                    generated_samples_canonical_sml.append(can_sml_mol)
+                    generated_samples_canonical_sml_set.add(can_sml_mol)
+                    iter_num_list.append(iter_num)
+                    idx += 1
+                    no_newly_generated_iter = 0
+                else:
+                    no_newly_generated_iter += 1
+                if (
+                    idx
+                    >= (args.num_generated_samples if to_generate == -1 else to_generate)
+                    or no_newly_generated_iter > 10
+                ):
+                    break
+        finally:
+            # Also write the last partial batch when generation raises
+            molecule_file.writelines(molecule_buffer)
 
     for _metric in metrics:
         assert _metric in ["diversity", "num_rules", "num_samples", "syn"]
@@ -91,8 +105,11 @@ def retro_sender(generated_samples, args):
             fcntl.flock(fr, fcntl.LOCK_UN)
     num_samples = len(generated_samples)
     print("Waiting for retro_star evaluation...")
+    receiver_path = f"{args.output_dir}/{args.receiver_file}"
+    receiver_signature = None
     while True:
-        with open(f"{args.output_dir}/{args.receiver_file}", "r") as fr:
+        receiver_signature = wait_for_update(receiver_path, receiver_signature)
+        with open(receiver_path, "r") as fr:
             editable = lock(fr)
             if editable:
                 syn_status = []
@@ -103,9 +120,20 @@ def retro_sender(generated_samples, args):
                         syn_status.append((idx, splitted_line[2]))
                     break
             fcntl.flock(fr, fcntl.LOCK_UN)
-        time.sleep(1)
     assert len(generated_samples) == len(syn_status)
-    return np.mean([int(eval(s[1])) for s in syn_status])
+    # The listener writes the plain strings "True"/"False"; compare instead of eval-ing them
+    syn_flags = np.fromiter(
+        (s[1] == "True" for s in syn_status), dtype=np.bool_, count=len(syn_status)
+    )
+    return syn_flags.mean()
+
+
+def write_file_atomic(path, data):
+    # Write next to the target and rename over it, so a crash never leaves a torn checkpoint
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
 
 
 def learn(smiles_list, args):
@@ -135,6 +163,12 @@ def learn(smiles_list, args):
     # Start training
     logger.info("starting\n")
     curr_max_R = 0
+    checkpoint_writer = ThreadPoolExecutor(max_workers=1)
+    checkpoint_futures = []
+    # Serialize the initial state once; unpickling is much cheaper than deepcopy per sample
+    input_graphs_dict_blob = pickle.dumps(
+        input_graphs_dict_init, pickle.HIGHEST_PROTOCOL
+    )
     for train_epoch in range(args.max_epoches):
         returns = []
         log_returns = []
@@ -142,10 +176,10 @@ def learn(smiles_list, args):
 
         # MCMC sampling
         for num in range(args.MCMC_size):
-            grammar_init = ProductionRuleCorpus()
-            l_input_graphs_dict = deepcopy(input_graphs_dict_init)
-            l_subgraph_set = deepcopy(subgraph_set_init)
-            l_grammar = deepcopy(grammar_init)
+            l_input_graphs_dict = pickle.loads(input_graphs_dict_blob)
+            # grammar_generation deep-copies the subgraph set before touching it, so share it
+            l_subgraph_set = subgraph_set_init
+            l_grammar = ProductionRuleCorpus()
             iter_num, l_grammar, l_input_graphs_dict = MCMC_sampling(
                 agent, l_input_graphs_dict, l_subgraph_set, l_grammar, num, args
             )
@@ -160,50 +194,62 @@ def learn(smiles_list, args):
             logger.info("======Sample {} returns {}=======:".format(num, R_ind))
             # Save ckpt
             if R_ind > curr_max_R:
-                torch.save(
-                    agent.state_dict(),
-                    os.path.join(
-                        save_log_path,
-                        "epoch_agent_{}_{}.pkl".format(train_epoch, R_ind),
+                # Snapshot in this thread, then overwrite the single best checkpoint in the background
+                agent_buffer = io.BytesIO()
+                torch.save(agent.state_dict(), agent_buffer)
+                best_checkpoint = {
+                    "best_agent.pkl": agent_buffer.getvalue(),
+                    "best_grammar.pkl": pickle.dumps(
+                        l_grammar, pickle.HIGHEST_PROTOCOL
                     ),
-                )
-                with open(
-                    "{}/epoch_grammar_{}_{}.pkl".format(
-                        save_log_path, train_epoch, R_ind
-                    ),
-                    "wb",
-                ) as outp:
-                    pickle.dump(l_grammar, outp, pickle.HIGHEST_PROTOCOL)
-                with open(
-                    "{}/epoch_input_graphs_{}_{}.pkl".format(
-                        save_log_path, train_epoch, R_ind
+                    "best_input_graphs.pkl": pickle.dumps(
+                        l_input_graphs_dict, pickle.HIGHEST_PROTOCOL
                     ),
-                    "wb",
-                ) as outp:
-                    pickle.dump(l_input_graphs_dict, outp, pickle.HIGHEST_PROTOCOL)
+                }
+                # Raise if writing the previous best checkpoint failed
+                for future in checkpoint_futures:
+                    future.result()
+                checkpoint_futures = [
+                    checkpoint_writer.submit(
+                        write_file_atomic, os.path.join(save_log_path, file_name), data
+                    )
+                    for file_name, data in best_checkpoint.items()
+                ]
+                logger.info(
+                    "Saving best checkpoint from epoch {} with return {}".format(
+                        train_epoch, R_ind
+                    )
+                )
                 curr_max_R = R_ind
 
         # Calculate loss
         returns = torch.tensor(returns)
         returns = returns - returns.mean()  # / (returns.std() + eps)
-        assert len(returns) == len(list(agent.saved_log_probs.keys()))
-        policy_loss = torch.tensor([0.0])
-        for sample_number in agent.saved_log_probs.keys():
-            max_iter_num = max(list(agent.saved_log_probs[sample_number].keys()))
-            for iter_num_key in agent.saved_log_probs[sample_number].keys():
-                log_probs = agent.saved_log_probs[sample_number][iter_num_key]
-                for log_prob in log_probs:
-                    policy_loss += (
-                        -log_prob
-                        * args.gammar ** (max_iter_num - iter_num_key)
-                        * returns[sample_number]
-                    ).sum()
+        sample_numbers = np.asarray(agent.saved_sample_numbers)
+        iter_nums = np.asarray(agent.saved_iter_nums)
+        assert len(returns) == len(np.unique(sample_numbers))
+        # Discounted return per saved action, repeated over the elements of its log-prob,
+        # so the loss is a single product + sum in the autograd graph
+        max_iter_nums = np.zeros(len(returns), dtype=iter_nums.dtype)
+        np.maximum.at(max_iter_nums, sample_numbers, iter_nums)
+        weights = (
+            args.gammar ** (max_iter_nums[sample_numbers] - iter_nums)
+            * returns.numpy()[sample_numbers]
+        )
+        log_prob_sizes = [log_prob.numel() for log_prob in agent.saved_log_probs]
+        flat_log_probs = torch.cat(
+            [log_prob.reshape(-1) for log_prob in agent.saved_log_probs]
+        )
+        weights = torch.from_numpy(np.repeat(weights, log_prob_sizes)).to(
+            flat_log_probs.dtype
+        )
+        policy_loss = -(flat_log_probs * weights).sum()
 
         # Back Propogation and update
         optimizer.zero_grad()
         policy_loss.backward()
         optimizer.step()
-        agent.saved_log_probs.clear()
+        agent.clear_saved_actions()
 
         # Log
         logger.info("Loss: {}".format(policy_loss.clone().item()))
@@ -220,6 +266,9 @@ def learn(smiles_list, args):
             "Mean evaluation metrics: {}".format(", ".join(mean_evaluation_metrics))
         )
 
+    for future in checkpoint_futures:
+        future.result()
+    checkpoint_writer.shutdown(wait=True)
     evaluate(l_grammar, args, metrics=[], to_generate=GENERATED_SO_FAR)
 
 
@@ -2,6 +2,8 @@ import torch
 import torch.multiprocessing as mp
 import numpy as np
 import fcntl
+import os
+import time
 import argparse
 import setproctitle
 from retro_star.api import RSPlanner
@@ -16,6 +18,18 @@ def lock(f):
     return True
 
 
+def wait_for_update(path, last_signature=None, timeout=1.0, poll_interval=0.05):
+    # Block until the file's (mtime, size) differs from `last_signature`, or until
+    # `timeout` elapses; stat-ing is much cheaper than re-opening and locking the file
+    deadline = time.monotonic() + timeout
+    while True:
+        st = os.stat(path)
+        signature = (st.st_mtime_ns, st.st_size)
+        if signature != last_signature or time.monotonic() >= deadline:
+            return signature
+        time.sleep(poll_interval)
+
+
 class Synthesisability:
     def __init__(self):
         self.planner = RSPlanner(
@@ -1,5 +1,4 @@
 from rdkit import Chem
-from copy import deepcopy
 import numpy as np
 from private import *
 from grammar_generation import *
@@ -15,7 +14,7 @@ import pprint
 import pickle
 import argparse
 import fcntl
-from retro_star_listener import lock
+from retro_star_listener import lock, wait_for_update
 
 
 def evaluate(grammar, args, metrics=['diversity', 'syn']):
@@ -24,6 +23,7 @@ def evaluate(grammar, args, metrics=['diversity', 'syn']):
     eval_metrics = {}
     generated_samples = []
     generated_samples_canonical_sml = []
+    generated_samples_canonical_sml_set = set()  # O(1) duplicate check
     iter_num_list = []
     idx = 0
     no_newly_generated_iter = 0
@@ -34,10 +34,11 @@ def evaluate(grammar, args, metrics=['diversity', 'syn']):
         if mol is None:
             no_newly_generated_iter += 1
             continue
-        can_sml_mol = Chem.CanonSmiles(Chem.MolToSmiles(mol))
-        if can_sml_mol not in generated_samples_canonical_sml:
+        can_sml_mol = Chem.MolToSmiles(mol, canonical=True)
+        if can_sml_mol not in generated_samples_canonical_sml_set:
             generated_samples.append(mol)
             generated_samples_canonical_sml.append(can_sml_mol)
+            generated_samples_canonical_sml_set.add(can_sml_mol)
             iter_num_list.append(iter_num)
             idx += 1
             no_newly_generated_iter = 0
@@ -77,7 +78,9 @@ def retro_sender(generated_samples, args):
             fcntl.flock(fr, fcntl.LOCK_UN)
     num_samples = len(generated_samples)
     print("Waiting for retro_star evaluation...")
+    receiver_signature = None
     while(True):
+        receiver_signature = wait_for_update(args.receiver_file, receiver_signature)
         with open(args.receiver_file, 'r') as fr:
             editable = lock(fr)
             if editable:
@@ -89,9 +92,10 @@ def retro_sender(generated_samples, args):
                         syn_status.append((idx, splitted_line[2]))
                     break
             fcntl.flock(fr, fcntl.LOCK_UN)
-        time.sleep(1)
     assert len(generated_samples) == len(syn_status)
-    return np.mean([int(eval(s[1])) for s in syn_status])
+    # The listener writes the plain strings "True"/"False"; compare instead of eval-ing them
+    syn_flags = np.fromiter((s[1] == 'True' for s in syn_status), dtype=np.bool_, count=len(syn_status))
+    return syn_flags.mean()
 
 
 def learn(smiles_list, args):
@@ -113,6 +117,8 @@ def learn(smiles_list, args):
     # Start training
     logger.info('starting\n')
     curr_max_R = 0
+    # Serialize the initial state once; unpickling is much cheaper than deepcopy per sample
+    input_graphs_dict_blob = pickle.dumps(input_graphs_dict_init, pickle.HIGHEST_PROTOCOL)
     for train_epoch in range(args.max_epoches):
         returns = []
         log_returns = []
@@ -120,10 +126,10 @@ def learn(smiles_list, args):
 
         # MCMC sampling
         for num in range(args.MCMC_size):
-            grammar_init = ProductionRuleCorpus()
-            l_input_graphs_dict = deepcopy(input_graphs_dict_init)
-            l_subgraph_set = deepcopy(subgraph_set_init)
-            l_grammar = deepcopy(grammar_init)
+            l_input_graphs_dict = pickle.loads(input_graphs_dict_blob)
+            # grammar_generation deep-copies the subgraph set before touching it, so share it
+            l_subgraph_set = subgraph_set_init
+            l_grammar = ProductionRuleCorpus()
             iter_num, l_grammar, l_input_graphs_dict = MCMC_sampling(agent, l_input_graphs_dict, l_subgraph_set, l_grammar, num, args)
             # Grammar evaluation
             eval_metric = evaluate(l_grammar, args, metrics=['diversity', 'syn'])
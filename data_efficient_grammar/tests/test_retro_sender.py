@@ -0,0 +1,67 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from argparse import Namespace
+
+import numpy as np
+from rdkit import Chem
+
+sys.path = [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] + sys.path
+
+import main  # noqa: E402
+import simple_main  # noqa: E402
+
+SMILES = ["CCO", "c1ccccc1", "CC(=O)O"]
+SYN_STATUS = ["True", "False", "True"]
+
+
+def fake_listener(args):
+    # Answer like retro_star_listener once the sender file holds the samples
+    sender_path = os.path.join(args.output_dir, args.sender_file)
+    receiver_path = os.path.join(args.output_dir, args.receiver_file)
+    while True:
+        with open(sender_path, "r") as fr:
+            lines = fr.read().split()
+        if len(lines) == len(SMILES):
+            break
+        time.sleep(0.01)
+    with open(receiver_path, "w") as fw:
+        for idx, (sml, status) in enumerate(zip(lines, SYN_STATUS)):
+            fw.write("{} {} {}\n".format(idx, sml, status))
+
+
+class TestRetroSender(unittest.TestCase):
+    def run_sender(self, module):
+        with tempfile.TemporaryDirectory() as output_dir:
+            args = Namespace(
+                output_dir=output_dir,
+                sender_file="sender.txt",
+                receiver_file="receiver.txt",
+            )
+            open(os.path.join(output_dir, args.sender_file), "w").close()
+            listener = threading.Thread(target=fake_listener, args=(args,))
+            listener.start()
+            syn = module.retro_sender([Chem.MolFromSmiles(s) for s in SMILES], args)
+            listener.join()
+        return syn
+
+    def check_reward(self, syn):
+        self.assertAlmostEqual(syn, 2 / 3)
+        # Same reward computation as in learn()
+        R = 0.5 + 2 * syn
+        R_ind = R.copy()
+        self.assertIsInstance(R_ind, np.floating)
+        self.assertAlmostEqual(R_ind, 0.5 + 4 / 3)
+
+    def test_main(self):
+        self.check_reward(self.run_sender(main))
+
+    def test_simple_main(self):
+        self.check_reward(self.run_sender(simple_main))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,16 @@
+import os
 import re
+import mmap
+import pickle
+import tempfile
 import typer
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import itertools as it
 from typing import Union
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 from rdkit import Chem
 from tqdm import tqdm
 from math import ceil, sqrt
@@ -52,24 +59,81 @@ def main(log: bool = False):
         plot_history(max_num_atoms, filtered_files, log)
 
 
+@lru_cache(maxsize=None)
+def canon_smiles(smiles: str) -> str:
+    # Generated histories repeat the same molecules many times, canonicalize each one once.
+    return Chem.CanonSmiles(smiles)
+
+
 def load_smiles_as_canon(max_num_atoms: int) -> list:
-    smiles = []
-    for line in open(f"/app/data/molecules/size_{max_num_atoms}/valid.smi"):
-        # mol = Chem.MolFromSmiles(line.strip())
-        canon = Chem.CanonSmiles(line)
-        smiles.append(canon)
+    # Canonicalize with a single parse per molecule; the result is cached next to the
+    # validation set and rebuilt whenever the .smi changes.
+    smi_path = Path(f"/app/data/molecules/size_{max_num_atoms}/valid.smi")
+    cache_path = smi_path.with_name(f"{smi_path.stem}.canon.pkl")
+    if cache_path.exists() and cache_path.stat().st_mtime >= smi_path.stat().st_mtime:
+        try:
+            with open(cache_path, "rb") as f:
+                return pickle.load(f)
+        except (EOFError, pickle.UnpicklingError):
+            # Torn cache, rebuild it below
+            pass
+
+    with open(smi_path) as f:
+        smiles = [
+            Chem.MolToSmiles(Chem.MolFromSmiles(line.strip()), canonical=True)
+            for line in f
+        ]
+
+    try:
+        # Write next to the target and rename over it, so a crash or a concurrent run
+        # never leaves a partial cache behind
+        fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, suffix=".tmp")
+    except OSError:
+        # Read-only data directory, just recompute next time
+        return smiles
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(smiles, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
     return smiles
 
 
-def convert_smiles_to_canon(smiles: list) -> list:
+def canon_smiles_or_none(smiles: str):
+    try:
+        return canon_smiles(smiles)
+    except:
+        return None
+
+
+def convert_smiles_to_canon(smiles, parallel_threshold: int = 10_000) -> list:
+    # Canonicalize every distinct SMILES once, on all cores when there are enough of them to pay for the workers.
+    # `smiles` may be any iterable; it is consumed in a single pass and only distinct strings are kept.
+    smile_to_idx = {}
+    order = []
+    for smile in smiles:
+        order.append(smile_to_idx.setdefault(smile, len(smile_to_idx)))
+    unique_smiles = list(smile_to_idx)
+    del smile_to_idx
+    if len(unique_smiles) >= parallel_threshold:
+        with ProcessPoolExecutor() as executor:
+            canons = list(
+                executor.map(canon_smiles_or_none, unique_smiles, chunksize=1024)
+            )
+    else:
+        canons = [canon_smiles_or_none(smile) for smile in unique_smiles]
+
     converted = []
     errored = 0
-    for smile in smiles:
-        try:
-            canon = Chem.CanonSmiles(smile)
-        except:
+    for idx in order:
+        canon = canons[idx]
+        if canon is None:
             errored += 1
-            print("Can not convert", smile)
+            print("Can not convert", unique_smiles[idx])
             continue
         converted.append(canon)
     if errored:
@@ -146,7 +210,7 @@ def plot_history(
         if not history:
             raise RuntimeError("No history for ", method, file)
             continue
-        history_dedup = dedup_by(history, lambda x: x)
+        history_dedup = dedup_by(history)
 
         molecule_counter = Counter(history)
         molecules_counters.append((method, molecule_counter))
@@ -255,127 +319,135 @@ def plot_history(
 
 def get_conf_matrix(molecule_counter, val_canons) -> pd.DataFrame:
     val_canons_set = set(val_canons)
-    counts = sorted(set(molecule_counter.values()), reverse=True)
-
-    data = []
-
-    for rank in counts:
-        generated_molecules_above_rank = set(
-            [m for m, c in molecule_counter.items() if c >= rank]
-        )
-        generated_molecules_below_rank = set(
-            [m for m, c in molecule_counter.items() if c < rank]
-        )
-
-        tp = len(generated_molecules_above_rank & val_canons_set)
-        fp = len(generated_molecules_above_rank - val_canons_set)
-        tn = len(generated_molecules_below_rank - val_canons_set)
-        fn = len(generated_molecules_below_rank & val_canons_set)
-
-        data.append(
-            {
-                "len_val_canons_set": len(val_canons_set),
-                "len_generated_molecules_above_rank": len(
-                    generated_molecules_above_rank
-                ),
-                "len_generated_molecules_below_rank": len(
-                    generated_molecules_below_rank
-                ),
-                "rank": rank,
-                "tp": tp,
-                "fp": fp,
-                "tn": tn,
-                "fn": fn,
-            }
-        )
+    molecules = list(molecule_counter)
+    counts = np.fromiter(
+        (molecule_counter[m] for m in molecules), dtype=np.int64, count=len(molecules)
+    )
+    in_val = np.fromiter(
+        (m in val_canons_set for m in molecules), dtype=bool, count=len(molecules)
+    )
 
-    df = pd.DataFrame.from_records(data)
+    # With the molecules sorted by count, the ones below a rank are a prefix,
+    # so the confusion matrix of every rank comes from cumulative sums.
+    order = np.argsort(counts, kind="stable")
+    counts = counts[order]
+    in_val_before = np.concatenate([[0], np.cumsum(in_val[order])])
+    ranks = np.unique(counts)[::-1]
+
+    below = np.searchsorted(counts, ranks, side="left")
+    above = len(molecules) - below
+    fn = in_val_before[below]
+    tn = below - fn
+    tp = in_val_before[-1] - fn
+    fp = above - tp
+
+    df = pd.DataFrame(
+        {
+            "len_val_canons_set": len(val_canons_set),
+            "len_generated_molecules_above_rank": above,
+            "len_generated_molecules_below_rank": below,
+            "rank": ranks,
+            "tp": tp,
+            "fp": fp,
+            "tn": tn,
+            "fn": fn,
+        }
+    )
     return df
 
 
 def get_cumulative_perc_deduplicated(gen_smiles, dataset_smiles):
     dataset_smiles_set = set(dataset_smiles)
 
-    recalls = []
-    precisions = []
-    sizes = []
-    subset = set()
+    # factorize numbers molecules in order of first appearance, so a position holds a new molecule
+    # exactly when its id exceeds every id before it; the running counts are then cumulative sums.
+    ids, uniques = pd.factorize(np.asarray(gen_smiles, dtype=object))
+    previous_max = np.concatenate(([-1], np.maximum.accumulate(ids)[:-1]))
+    is_new = ids > previous_max
+    in_dataset = np.fromiter(
+        (molecule in dataset_smiles_set for molecule in uniques),
+        dtype=bool,
+        count=len(uniques),
+    )
 
-    for molecule in tqdm(gen_smiles):
-        subset.add(molecule)
-        recalls.append(len(subset & dataset_smiles_set) / len(dataset_smiles_set))
-        precisions.append(len(subset & dataset_smiles_set) / len(subset))
-        sizes.append(len(subset))
+    sizes = np.cumsum(is_new)
+    hits = np.cumsum(is_new & in_dataset[ids])
+    recalls = hits / len(dataset_smiles_set)
+    precisions = hits / sizes
 
     return sizes, recalls, precisions
 
 
-def get_molecule_history(filepath: Union[str, Path]) -> list:
-    history = []
-    with open(filepath) as file:
-        for idx, line in tqdm(enumerate(file), desc=f"Reading {filepath}"):
-            line = line.strip()
-            if not line:
-                continue
+def iter_history_smiles(filepath: Union[str, Path]):
+    # Lines are read as raw bytes from a memory map; only the SMILES token gets decoded.
+    is_moler = "moler" in str(filepath)
+    with open(filepath, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for idx, line in tqdm(
+                enumerate(iter(mm.readline, b"")), desc=f"Reading {filepath}"
+            ):
+                items = line.split()
+                if not items:
+                    continue
+
+                if is_moler and idx < 20 and len(items) > 1:
+                    # Output made of >, not actual molecules.
+                    continue
+                elif len(items) == 3:
+                    smile = items[2]
+                elif len(items) == 2 and items[1] == b"working":
+                    smile = items[0]
+                elif len(items) == 1:
+                    smile = items[0]
+                else:
+                    raise Exception(f"Unknown format, {[x.decode() for x in items]}")
+
+                yield smile.decode()
 
-            items = line.split()
 
-            if "moler" in str(filepath) and idx < 20 and len(items) > 1:
-                # Output made of >, not actual molecules.
-                continue
-            elif len(items) == 3:
-                smile = items[2]
-            elif len(items) == 2 and items[1] == "working":
-                smile = items[0]
-            elif len(items) == 1:
-                smile = items[0]
-            else:
-                raise Exception(f"Unknown format, {items}")
-
-            history.append(smile)
+def get_molecule_history(filepath: Union[str, Path]) -> list:
+    return convert_smiles_to_canon(iter_history_smiles(filepath))
 
-    return convert_smiles_to_canon(history)
 
+def dedup_by(smiles: list, callable=None) -> list:
+    if callable is None:
+        # Identity key, let the C-level ordered dict do the work.
+        return list(dict.fromkeys(smiles))
 
-def dedup_by(smiles: list, callable=lambda x: x) -> list:
     seen = set()
     deduped = []
     for smile in smiles:
-        if callable(smile) not in seen:
+        key = callable(smile)
+        if key not in seen:
             deduped.append(smile)
-            seen.add(callable(smile))
+            seen.add(key)
     return deduped
 
 
-def filepath_to_title(filepath: Path) -> str:
-    filepath_str = str(filepath)
-
-    if "DiGress" and "continuous" in filepath_str:
-        return "DiGress continuous"
-
-    elif "DiGress" and "discrete" in filepath_str:
-        return "DiGress discrete"
-
-    elif "paccmann" in filepath_str and "vae" in filepath_str:
-        return "Paccmann VAE"
+# Checked in order; the first matching pattern decides the title.
+# The DiGress and RNN rules only look at the second term, as the original checks did.
+FILEPATH_TITLE_RULES = [
+    (re.compile(r"continuous"), "DiGress continuous"),
+    (re.compile(r"discrete"), "DiGress discrete"),
+    (re.compile(r"(?=.*paccmann).*vae"), "Paccmann VAE"),
+    (re.compile(r"moler", re.IGNORECASE), "MoLeR"),
+    (re.compile(r"data_efficient_grammar", re.IGNORECASE), "Data Efficient Grammar"),
+    (re.compile(r"selfies", re.IGNORECASE), "RNN Selfies"),
+    (re.compile(r"regex", re.IGNORECASE), "RNN Regex"),
+    (re.compile(r"char", re.IGNORECASE), "RNN Char"),
+]
 
-    elif "moler" in filepath_str.lower():
-        return "MoLeR"
 
-    elif "data_efficient_grammar" in filepath_str.lower():
-        return "Data Efficient Grammar"
-
-    elif "rnn" and "selfies" in filepath_str.lower():
-        return "RNN Selfies"
-
-    elif "rnn" and "regex" in filepath_str.lower():
-        return "RNN Regex"
+def filepath_to_title(filepath: Path) -> str:
+    filepath_str = str(filepath)
 
-    elif "rnn" and "char" in filepath_str.lower():
-        return "RNN Char"
+    for pattern, title in FILEPATH_TITLE_RULES:
+        if pattern.search(filepath_str):
+            return title
 
-    else:
-        raise RuntimeError(f"Unknown method for {filepath}")
+    raise RuntimeError(f"Unknown method for {filepath}")
 
 
 def flat(list_of_lists):
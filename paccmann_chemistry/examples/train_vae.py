@@ -6,10 +6,15 @@ import logging
 import os
 import sys
 from time import time
-from paccmann_chemistry.utils import collate_fn, get_device, disable_rdkit_logging
+from paccmann_chemistry.utils import (
+    collate_fn_flat,
+    get_device,
+    disable_rdkit_logging,
+)
 from paccmann_chemistry.models.vae import StackGRUDecoder, StackGRUEncoder, TeacherVAE
 from paccmann_chemistry.models.training import train_vae
-from paccmann_chemistry.utils.hyperparams import SEARCH_FACTORY
+from paccmann_chemistry.utils.datasets import TokenIndexDataset
+from paccmann_chemistry.utils.hyperparams import SEARCH_FACTORY, get_optimizer
 from pytoda.datasets import SMILESDataset, SMILESTokenizerDataset
 from pytoda.smiles.smiles_language import SMILESLanguage
 from torch.utils.tensorboard import SummaryWriter
@@ -69,7 +74,7 @@ def main(parser_namespace):
         model_path = parser_namespace.model_path
         training_name = parser_namespace.training_name
 
-        writer = SummaryWriter(f"logs/{training_name}")
+        writer = SummaryWriter(f"logs/{training_name}", flush_secs=120)
 
         logger.info(f"Model with name {training_name} starts.")
 
@@ -88,10 +93,8 @@ def main(parser_namespace):
 
         logger.info(f"Smiles filepath: {train_smiles_filepath}")
 
-        # create SMILES eager dataset
-        smiles_train_data_with_lang = SMILESTokenizerDataset(
-            train_smiles_filepath,
-            smiles_language=smiles_language,
+        # create SMILES eager datasets, all splits share the same settings
+        dataset_kwargs = dict(
             padding=False,
             selfies=params.get("selfies", False),
             add_start_and_stop=params.get("add_start_stop_token", True),
@@ -103,46 +106,40 @@ def main(parser_namespace):
             remove_bonddir=params.get("remove_bonddir", False),
             remove_chirality=params.get("remove_chirality", False),
             backend="eager",
-            device=device,
+            device=torch.device("cpu"),
+        )
+        # Built once: learns the language if none was given, then serves as
+        # the training set
+        smiles_train_data = SMILESTokenizerDataset(
+            train_smiles_filepath, smiles_language=smiles_language, **dataset_kwargs
         )
         if smiles_language_filepath is None:
-            smiles_language = smiles_train_data_with_lang.smiles_language
+            smiles_language = smiles_train_data.smiles_language
             smiles_language.save(os.path.join(model_path, f"{training_name}.lang"))
         else:
             smiles_language_filename = os.path.basename(smiles_language_filepath)
             smiles_language.save(os.path.join(model_dir, smiles_language_filename))
-        smiles_train_data = SMILESTokenizerDataset(
-            train_smiles_filepath,
-            smiles_language=smiles_language,
-            padding=False,
-            selfies=params.get("selfies", False),
-            add_start_and_stop=params.get("add_start_stop_token", True),
-            augment=params.get("augment_smiles", False),
-            canonical=params.get("canonical", False),
-            kekulize=params.get("kekulize", False),
-            all_bonds_explicit=params.get("all_bonds_explicit", False),
-            all_hs_explicit=params.get("all_hs_explicit", False),
-            remove_bonddir=params.get("remove_bonddir", False),
-            remove_chirality=params.get("remove_chirality", False),
-            backend="eager",
-            device=device,
-        )
         smiles_test_data = SMILESTokenizerDataset(
-            test_smiles_filepath,
-            smiles_language=smiles_language,
-            padding=False,
-            selfies=params.get("selfies", False),
-            add_start_and_stop=params.get("add_start_stop_token", True),
-            augment=params.get("augment_smiles", False),
-            canonical=params.get("canonical", False),
-            kekulize=params.get("kekulize", False),
-            all_bonds_explicit=params.get("all_bonds_explicit", False),
-            all_hs_explicit=params.get("all_hs_explicit", False),
-            remove_bonddir=params.get("remove_bonddir", False),
-            remove_chirality=params.get("remove_chirality", False),
-            backend="eager",
-            device=device,
+            test_smiles_filepath, smiles_language=smiles_language, **dataset_kwargs
         )
+        # Augmentation draws a new SMILES on every access, nothing to cache
+        if not dataset_kwargs["augment"]:
+            # Tokenize every split once and memory map the token indexes, so
+            # DataLoader workers only slice a shared array
+            data_dir = os.path.join(model_dir, "data")
+            tokenization_workers = params.get("tokenization_workers", os.cpu_count())
+            smiles_train_data = TokenIndexDataset.save(
+                smiles_train_data,
+                os.path.join(data_dir, "train"),
+                smiles_language=smiles_language,
+                num_workers=tokenization_workers,
+            )
+            smiles_test_data = TokenIndexDataset.save(
+                smiles_test_data,
+                os.path.join(data_dir, "test"),
+                smiles_language=smiles_language,
+                num_workers=tokenization_workers,
+            )
 
         params.update(
             {
@@ -151,15 +148,11 @@ def main(parser_namespace):
             }
         )
 
-        vocab_dict = smiles_language.index_to_token
+        token_to_index = smiles_language.token_to_index
         params.update(
             {
-                "start_index": list(vocab_dict.keys())[
-                    list(vocab_dict.values()).index("<START>")
-                ],
-                "end_index": list(vocab_dict.keys())[
-                    list(vocab_dict.values()).index("<STOP>")
-                ],
+                "start_index": token_to_index["<START>"],
+                "end_index": token_to_index["<STOP>"],
             }
         )
 
@@ -170,24 +163,29 @@ def main(parser_namespace):
             json.dump(params, fp)
 
         # create DataLoaders
-        train_data_loader = torch.utils.data.DataLoader(
-            smiles_train_data,
+        loader_kwargs = dict(
             batch_size=params.get("batch_size", 64),
-            collate_fn=collate_fn,
+            collate_fn=collate_fn_flat,
             drop_last=True,
             shuffle=True,
             pin_memory=params.get("pin_memory", True),
-            num_workers=params.get("num_workers", 8),
+            # Cached token indexes only need slicing, augmentation still
+            # tokenizes on every access
+            num_workers=params.get(
+                "num_workers", 8 if dataset_kwargs["augment"] else 2
+            ),
+        )
+        if loader_kwargs["num_workers"] > 0:
+            # keep workers alive across epochs and a few batches ahead
+            loader_kwargs.update(
+                persistent_workers=True,
+                prefetch_factor=params.get("prefetch_factor", 4),
+            )
+        train_data_loader = torch.utils.data.DataLoader(
+            smiles_train_data, **loader_kwargs
         )
-
         test_data_loader = torch.utils.data.DataLoader(
-            smiles_test_data,
-            batch_size=params.get("batch_size", 64),
-            collate_fn=collate_fn,
-            drop_last=True,
-            shuffle=True,
-            pin_memory=params.get("pin_memory", True),
-            num_workers=params.get("num_workers", 8),
+            smiles_test_data, **loader_kwargs
         )
         # initialize encoder and decoder
         gru_encoder = StackGRUEncoder(params).to(device)
@@ -207,6 +205,12 @@ def main(parser_namespace):
             logger.info(f"Param {name}, shape:\t{parameter.shape}")
         total_params = sum(p.numel() for p in gru_vae.parameters())
         logger.info(f"Total # params: {total_params}")
+        # Compile once here rather than in train_vae, which runs once per epoch
+        if params.get("compile", False):
+            if hasattr(torch, "compile"):
+                gru_vae = torch.compile(gru_vae, dynamic=True)
+            else:
+                logger.warning("torch.compile needs torch>=2.0, training eagerly.")
 
         loss_tracker = {
             "test_loss_a": 10e4,
@@ -238,6 +242,16 @@ def main(parser_namespace):
             pprint(pparams)
             writer.add_hparams(hparam_dict=pparams, metric_dict={})
 
+        # Built once so its state (e.g. Adam moments) carries over epochs
+        optimizer = get_optimizer(
+            params.get("optimizer", "adadelta"),
+            gru_vae.parameters(),
+            lr=params["learning_rate"],
+        )
+        amp_dtype = params.get("amp_dtype", None)
+        # fp16 needs loss scaling; keep one scaler so its scale carries over epochs
+        scaler = torch.cuda.amp.GradScaler() if amp_dtype == "float16" else None
+
         for epoch in range(params["epochs"] + 1):
             t = time()
             loss_tracker = train_vae(
@@ -248,8 +262,7 @@ def main(parser_namespace):
                 smiles_language,
                 model_dir,
                 search=decoder_search,
-                optimizer=params.get("optimizer", "adadelta"),
-                lr=params["learning_rate"],
+                optimizer=optimizer,
                 kl_growth=params["kl_growth"],
                 input_keep=params["input_keep"],
                 test_input_keep=params["test_input_keep"],
@@ -262,6 +275,8 @@ def main(parser_namespace):
                 # writer=writer,
                 batch_mode=params.get("batch_mode"),
                 total_epochs=params["epochs"],
+                amp_dtype=amp_dtype,
+                scaler=scaler,
             )
             logger.info(f"Epoch {epoch}, took {time() - t:.1f}.")
 
@@ -283,14 +298,13 @@ def main(parser_namespace):
 
 
 def framerize(path):
-    with open(path) as f:
-        lines = f.readlines()
-
     new_path = f"{path}.framed"
-    with open(new_path, "w") as f:
-        # f.write("SMILES\tindex\n")
-        for idx, line in enumerate(lines):
-            f.write(f"{line.strip()}\t{idx}\n")
+    # Stream bytes through large buffers instead of decoding the whole file
+    with open(path, "rb") as fin, open(new_path, "wb", buffering=1 << 20) as fout:
+        # fout.write(b"SMILES\tindex\n")
+        fout.writelines(
+            b"%s\t%d\n" % (line.strip(), idx) for idx, line in enumerate(fin)
+        )
 
     return new_path
 
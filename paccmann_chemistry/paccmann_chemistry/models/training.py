@@ -1,13 +1,16 @@
 """Train and Test Functions and Utilities."""
+import contextlib
 import json
 import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from time import time
 
 import numpy as np
 import torch
 
 from ..utils import (
-    crop_start_stop,
+    FlatBatch,
     get_device,
     packed_sequential_data_preparation,
     print_example_reconstruction,
@@ -22,8 +25,28 @@ from rdkit.Chem import Draw
 
 GENERATED_MOLECULES = 0
 
+AMP_DTYPES = {"bfloat16": torch.bfloat16, "float16": torch.float16}
 
-def test_vae(model, dataloader, logger, input_keep, batch_mode):
+# No version counter or view tracking at all; torch<1.9 falls back to no_grad
+inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+
+POSTPROCESS_WORKERS = 4
+_postprocess_pool = None
+
+
+def get_autocast(amp_dtype, device):
+    """Mixed-precision context for the forward pass.
+
+    Args:
+        amp_dtype (str): One of AMP_DTYPES, or None to run in full precision.
+        device (torch.device): Device the model runs on.
+    """
+    if amp_dtype is None:
+        return contextlib.ExitStack()
+    return torch.autocast(device_type=device.type, dtype=AMP_DTYPES[amp_dtype])
+
+
+def test_vae(model, dataloader, logger, input_keep, batch_mode, amp_dtype=None):
     """
     VAE test function.
 
@@ -33,6 +56,8 @@ def test_vae(model, dataloader, logger, input_keep, batch_mode):
         logger (logging.Logger): To display information on the fly.
         input_keep (float): The probability not to drop input sequence tokens
             according to a Bernoulli distribution with p = input_keep.
+        amp_dtype (str): Autocast dtype for the forward pass, "bfloat16" or
+            "float16". Defaults to None (full precision).
 
     Returns:
         float: average test loss over the entire test data.
@@ -42,16 +67,23 @@ def test_vae(model, dataloader, logger, input_keep, batch_mode):
     vae_model = model.to(device)
     vae_model.eval()
     test_loss, test_rec, test_kl_div = 0, 0, 0
-    with torch.no_grad():
-        for _iter, batch in enumerate(dataloader):
+    with inference_mode():
+        batches = prefetch_batches(
+            dataloader,
+            data_preparation,
+            device,
+            input_keep=input_keep,
+            start_index=2,
+            end_index=3,
+        )
+        for _iter, (encoder_seq, decoder_seq, target_seq) in enumerate(batches):
             if (_iter + 1) % 500 == 0:
                 logger.info(f"**TESTING**\t Processing batch {_iter}/{len(dataloader)}")
 
-            (encoder_seq, decoder_seq, target_seq) = data_preparation(
-                batch, input_keep=input_keep, start_index=2, end_index=3, device=device
-            )
-
-            decoder_loss, mu, logvar = vae_model(encoder_seq, decoder_seq, target_seq)
+            with get_autocast(amp_dtype, device):
+                decoder_loss, mu, logvar = vae_model(
+                    encoder_seq, decoder_seq, target_seq
+                )
             loss, kl_div = vae_loss_function(decoder_loss, mu, logvar, eval_mode=True)
             test_loss += loss.item()
             test_rec += decoder_loss.item()
@@ -87,6 +119,8 @@ def train_vae(
     batch_mode="padded",
     writer=None,
     total_epochs=-1,
+    amp_dtype=None,
+    scaler=None,
 ):  # yapf: disable
     """
     VAE train function.
@@ -103,8 +137,11 @@ def train_vae(
             be saved.
         search (paccmann_chemistry.utils.search.Search): search strategy
                 used in the decoder.
-        optimizer (str): Choice from OPTIMIZER_FACTORY. Defaults to 'adam'.
-        lr (float): The learning rate.
+        optimizer (str or torch.optim.Optimizer): Choice from
+            OPTIMIZER_FACTORY, or an optimizer built once over the model's
+            parameters so its state carries over between epochs.
+            Defaults to 'adam'.
+        lr (float): The learning rate, only used if `optimizer` is a str.
         kl_growth (float): The rate at which the weight grows.
             Defaults to 0.0015 resulting in a weight of 1 around step=9000.
         input_keep (float): The probability not to drop input sequence tokens
@@ -122,6 +159,10 @@ def train_vae(
             losses and respective epoch.
         logger (logging.Logger): To display information on the fly.
         batch_mode (str): Batch mode to use.
+        amp_dtype (str): Autocast dtype for the forward pass and loss,
+            "bfloat16" or "float16". Defaults to None (full precision).
+        scaler (torch.cuda.amp.GradScaler): Loss scaler, needed with
+            "float16" to avoid gradient underflow. Defaults to None.
 
     Returns:
          dict: updated loss_tracker.
@@ -142,44 +183,60 @@ def train_vae(
     data_preparation = get_data_preparation(batch_mode)
     vae_model = model.to(device)
     vae_model.train()
-    train_loss = 0
-    optimizer = OPTIMIZER_FACTORY[optimizer](vae_model.parameters(), lr=lr)
+    # Running sums of (loss, reconstruction, KL), kept on device and synced to
+    # host only when logged
+    train_losses = torch.zeros(3, device=device)
+    if isinstance(optimizer, str):
+        optimizer = OPTIMIZER_FACTORY[optimizer](vae_model.parameters(), lr=lr)
+    n_batches = len(train_dataloader)
+    stop_index = train_dataloader.dataset.smiles_language.stop_index
+    start_idx_t = torch.tensor(
+        [train_dataloader.dataset.smiles_language.start_index], device=device
+    )
+    stop_idx_t = torch.tensor([stop_index], device=device)
     t = time()
-    for _iter, batch in enumerate(train_dataloader):
-        global_step = epoch * len(train_dataloader) + _iter
-
-        encoder_seq, decoder_seq, target_seq = data_preparation(
-            batch,
-            input_keep=input_keep,
-            start_index=start_index,
-            end_index=end_index,
-            device=device,
-        )
-
-        optimizer.zero_grad()
-        decoder_loss, mu, logvar = vae_model(encoder_seq, decoder_seq, target_seq)
-        loss, kl_div = vae_loss_function(
-            decoder_loss, mu, logvar, kl_growth=kl_growth, step=global_step
-        )
-        loss.backward()
-        train_loss += loss.detach().item()
-
-        optimizer.step()
-        torch.cuda.empty_cache()
+    batches = prefetch_batches(
+        train_dataloader,
+        data_preparation,
+        device,
+        input_keep=input_keep,
+        start_index=start_index,
+        end_index=end_index,
+    )
+    for _iter, (encoder_seq, decoder_seq, target_seq) in enumerate(batches):
+        global_step = epoch * n_batches + _iter
 
-        if writer:
-            writer.add_scalar("train/loss", loss.item(), global_step=global_step)
-            writer.add_scalar("train/loss_dec", loss.item(), global_step=global_step)
-            writer.add_scalar("train/kl_div", loss.item(), global_step=global_step)
+        optimizer.zero_grad(set_to_none=True)
+        with get_autocast(amp_dtype, device):
+            decoder_loss, mu, logvar = vae_model(encoder_seq, decoder_seq, target_seq)
+            loss, kl_div = vae_loss_function(
+                decoder_loss, mu, logvar, kl_growth=kl_growth, step=global_step
+            )
+        if scaler is not None:
+            scaler.scale(loss).backward()
+        else:
+            loss.backward()
+        train_losses += torch.stack([loss, decoder_loss, kl_div]).detach().float()
+
+        if scaler is not None:
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            optimizer.step()
 
         if _iter and _iter % log_interval == 0:
+            train_loss, train_rec, train_kld = (train_losses / log_interval).tolist()
             logger.info(
                 f"***TRAINING***\t Epoch: {epoch}, "
-                f"step {_iter}/{len(train_dataloader)}.\t"
-                f"Loss: {train_loss/log_interval:2.4f}, time spent: {time()-t}"
+                f"step {_iter}/{n_batches}.\t"
+                f"Loss: {train_loss:2.4f}, time spent: {time()-t}"
             )
+            if writer:
+                writer.add_scalar("train/loss", train_loss, global_step=global_step)
+                writer.add_scalar("train/loss_dec", train_rec, global_step=global_step)
+                writer.add_scalar("train/kl_div", train_kld, global_step=global_step)
             t = time()
-            train_loss = 0
+            train_losses.zero_()
 
             if batch_mode == "packed":
                 target_seq = unpack_sequence(target_seq)
@@ -213,104 +270,113 @@ def train_vae(
             )
             vae_model.save(save_dir)
             logger.info(f"***SAVING***\t Epoch {epoch}, saved model.")
-        is_final = epoch == total_epochs
-        if is_final or (epoch and epoch % eval_interval == 0):
-            vae_model.eval()
-            latent_z = torch.randn(1, mu.shape[0], mu.shape[1]).to(device)
-            molecule_iter = vae_model.generate(
-                latent_z,
-                prime_input=torch.tensor(
-                    [train_dataloader.dataset.smiles_language.start_index]
-                ).to(device),
-                end_token=torch.tensor(
-                    [train_dataloader.dataset.smiles_language.stop_index]
-                ).to(device),
+
+    # Evaluate once per epoch, with the latent size of the last batch
+    is_final = epoch == total_epochs
+    if is_final or (epoch and epoch % eval_interval == 0):
+        vae_model.eval()
+        decoder_batch_size = vae_model.decoder.batch_size
+        generation_decoder = get_generation_decoder(vae_model.decoder, device)
+        with inference_mode():
+            generated = generate_in_batches(
+                generation_decoder,
+                mu.shape[0],
+                mu.shape[1],
+                prime_input=start_idx_t,
+                end_token=stop_idx_t,
                 generate_len=generate_len if not is_final else GENERATED_MOLECULES,
                 search=search,
+                device=device,
             )
-            with open(
-                f"{model_dir}/generated_molecules.{'in-training.txt' if not is_final else 'the-end'}",
-                "a",
-            ) as f:
-                for mol in molecule_iter:
-                    GENERATED_MOLECULES += 1
-                    mol = smiles_language.token_indexes_to_smiles(
-                        crop_start_stop(mol, smiles_language)
-                    )
-                    # SELFIES conversion if necessary
-                    mol = smiles_language.selfies_to_smiles(mol) if selfies else mol
-                    mol = mol.strip()
-                    if mol:
-                        logger.info(f"\nSample Generated Molecule:\n{mol}")
-                        f.write(f"{mol}\n")
-
-            # if writer:
-            #     writer.add_text("mol/test/generated", f"{mol}", global_step=global_step)
-            #     mol = Chem.MolFromSmiles(mol)
-            #     if mol:
-            #         writer.add_image(
-            #             "mol/test/generated",
-            #             np.array(Draw.MolsToImage([mol])),
-            #             dataformats="HWC",
-            #             global_step=global_step,
-            #         )
-            # target, pred = print_example_reconstruction(
-            #     vae_model.decoder.outputs, target_seq, smiles_language, selfies
-            # )
-            # if writer:
-            #     writer.add_text(
-            #         "mol/test/reconstructed",
-            #         f"Sample\t{target}\nReconstr:\t{pred}",
-            #         global_step=global_step,
-            #     )
-            #     mol = Chem.MolFromSmiles(target)
-            #     molt = Chem.MolFromSmiles(pred)
-            #     if mol and molt:
-            #         writer.add_image(
-            #             "mol/test/reconstructed",
-            #             np.array(Draw.MolsToImage([mol, molt])),
-            #             dataformats="HWC",
-            #             global_step=global_step,
-            #         )
-
-            # test_loss, test_rec, test_kld = test_vae(
-            #     vae_model, val_dataloader, logger, test_input_keep, batch_mode
-            # )
-            # logger.info(
-            #     f"***TESTING*** \t Epoch {epoch}, test loss = "
-            #     f"{test_loss:.4f}, reconstruction = {test_rec:.4f}, "
-            #     f"KL = {test_kld:.4f}."
-            # )
-            vae_model.train()
-            # if writer:
-            #     writer.add_scalar("test/loss", test_loss, global_step=global_step)
-            #     writer.add_scalar("test/loss_dec", test_rec, global_step=global_step)
-            #     writer.add_scalar("test/kl_div", test_kld, global_step=global_step)
-            # if test_loss < loss_tracker["test_loss_a"]:
-            #     loss_tracker.update({"test_loss_a": test_loss, "ep_loss": epoch})
-            #     vae_model.save(os.path.join(model_dir, f"weights/best_loss.pt"))
-            #     logger.info(
-            #         f"Epoch {epoch}. NEW best test loss = {test_loss:.4f} \t"
-            #         f"(Rec = {test_rec:.4f}, KLD = {test_kld:.4f})."
-            #     )
-
-            # if test_rec < loss_tracker["test_rec_a"]:
-            #     loss_tracker.update({"test_rec_a": test_rec, "ep_rec": epoch})
-            #     vae_model.save(os.path.join(model_dir, f"weights/best_rec.pt"))
-            #     logger.info(
-            #         f"Epoch {epoch}. NEW best reconstruction loss = "
-            #         f"{test_rec:.4f} \t (Loss = {test_loss:.4f}, KLD = "
-            #         f"{test_kld:.4f})"
-            #     )
-            # if test_kld < loss_tracker["test_kld_a"]:
-            #     loss_tracker.update({"test_kld_a": test_kld, "ep_kld": epoch})
-            #     vae_model.save(os.path.join(model_dir, f"weights/best_kld.pt"))
-            #     logger.info(
-            #         f"Epoch {epoch}. NEW best KLD = {test_kld:.4f} \t (loss "
-            #         f"= {test_loss:.4f}, Reconstruction = {test_rec:.4f})."
-            #     )
-            # with open(os.path.join(model_dir, "loss_tracker.json"), "w") as fp:
-            #     json.dump(loss_tracker, fp)
+        # Generation resized the decoder's initial states (as inference
+        # tensors), rebuild them for training
+        vae_model.decoder._update_batch_size(decoder_batch_size)
+        # Drop the start token and everything from the first stop token on,
+        # the stop positions are found for all molecules at once
+        token_indexes = generated[:, 1:].numpy()
+        is_stop = token_indexes == stop_index
+        ends = np.where(
+            is_stop.any(axis=1), is_stop.argmax(axis=1), token_indexes.shape[1]
+        )
+        sequences = [row[:end].tolist() for row, end in zip(token_indexes, ends)]
+        GENERATED_MOLECULES += len(sequences)
+        submit_postprocessing(
+            sequences,
+            smiles_language,
+            f"{model_dir}/generated_molecules."
+            f"{'in-training.txt' if not is_final else 'the-end'}",
+            logger,
+        )
+        if is_final:
+            shutdown_postprocessing()
+
+        # if writer:
+        #     writer.add_text("mol/test/generated", f"{mol}", global_step=global_step)
+        #     mol = Chem.MolFromSmiles(mol)
+        #     if mol:
+        #         writer.add_image(
+        #             "mol/test/generated",
+        #             np.array(Draw.MolsToImage([mol])),
+        #             dataformats="HWC",
+        #             global_step=global_step,
+        #         )
+        # target, pred = print_example_reconstruction(
+        #     vae_model.decoder.outputs, target_seq, smiles_language, selfies
+        # )
+        # if writer:
+        #     writer.add_text(
+        #         "mol/test/reconstructed",
+        #         f"Sample\t{target}\nReconstr:\t{pred}",
+        #         global_step=global_step,
+        #     )
+        #     mol = Chem.MolFromSmiles(target)
+        #     molt = Chem.MolFromSmiles(pred)
+        #     if mol and molt:
+        #         writer.add_image(
+        #             "mol/test/reconstructed",
+        #             np.array(Draw.MolsToImage([mol, molt])),
+        #             dataformats="HWC",
+        #             global_step=global_step,
+        #         )
+
+        # test_loss, test_rec, test_kld = test_vae(
+        #     vae_model, val_dataloader, logger, test_input_keep, batch_mode
+        # )
+        # logger.info(
+        #     f"***TESTING*** \t Epoch {epoch}, test loss = "
+        #     f"{test_loss:.4f}, reconstruction = {test_rec:.4f}, "
+        #     f"KL = {test_kld:.4f}."
+        # )
+        vae_model.train()
+        # if writer:
+        #     writer.add_scalar("test/loss", test_loss, global_step=global_step)
+        #     writer.add_scalar("test/loss_dec", test_rec, global_step=global_step)
+        #     writer.add_scalar("test/kl_div", test_kld, global_step=global_step)
+        # if test_loss < loss_tracker["test_loss_a"]:
+        #     loss_tracker.update({"test_loss_a": test_loss, "ep_loss": epoch})
+        #     vae_model.save(os.path.join(model_dir, f"weights/best_loss.pt"))
+        #     logger.info(
+        #         f"Epoch {epoch}. NEW best test loss = {test_loss:.4f} \t"
+        #         f"(Rec = {test_rec:.4f}, KLD = {test_kld:.4f})."
+        #     )
+
+        # if test_rec < loss_tracker["test_rec_a"]:
+        #     loss_tracker.update({"test_rec_a": test_rec, "ep_rec": epoch})
+        #     vae_model.save(os.path.join(model_dir, f"weights/best_rec.pt"))
+        #     logger.info(
+        #         f"Epoch {epoch}. NEW best reconstruction loss = "
+        #         f"{test_rec:.4f} \t (Loss = {test_loss:.4f}, KLD = "
+        #         f"{test_kld:.4f})"
+        #     )
+        # if test_kld < loss_tracker["test_kld_a"]:
+        #     loss_tracker.update({"test_kld_a": test_kld, "ep_kld": epoch})
+        #     vae_model.save(os.path.join(model_dir, f"weights/best_kld.pt"))
+        #     logger.info(
+        #         f"Epoch {epoch}. NEW best KLD = {test_kld:.4f} \t (loss "
+        #         f"= {test_loss:.4f}, Reconstruction = {test_rec:.4f})."
+        #     )
+        # with open(os.path.join(model_dir, "loss_tracker.json"), "w") as fp:
+        #     json.dump(loss_tracker, fp)
 
     logger.info(
         f"Epoch {epoch} finished, \t Training Loss = {loss.item():.4f},"
@@ -321,26 +387,244 @@ def train_vae(
     return loss_tracker
 
 
+def get_generation_decoder(decoder, device):
+    """
+    Decoder to generate molecules with.
+
+    On the CPU this is an int8 dynamically quantized copy of the decoder
+    (GRU and linear layers), the decoder itself is left untouched for
+    training. PyTorch has no quantized kernels for CUDA, there the decoder
+    is used as is.
+
+    Args:
+        decoder (StackGRUDecoder): The trained decoder.
+        device (torch.device): Device generation runs on.
+
+    Returns:
+        StackGRUDecoder: The decoder to generate with.
+    """
+    if device.type != "cpu":
+        return decoder
+    return torch.quantization.quantize_dynamic(
+        decoder, {torch.nn.GRU, torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def generate_in_batches(
+    decoder,
+    n_molecules,
+    latent_dim,
+    prime_input,
+    end_token,
+    generate_len,
+    search,
+    device,
+):
+    """
+    Generate molecules from random latent codes, retrying on GPU OOM.
+
+    All molecules are generated in one batch; whenever that runs out of GPU
+    memory the batch size is halved and generation continues in smaller
+    batches.
+
+    Args:
+        decoder (StackGRUDecoder): Decoder to generate with.
+        n_molecules (int): Number of molecules to generate.
+        latent_dim (int): Size of the latent codes.
+        prime_input (torch.Tensor): Indices of the priming string.
+        end_token (torch.Tensor): End token of shape `[1]`.
+        generate_len (int): Length of the generated molecules.
+        search (paccmann_chemistry.utils.search.Search): search strategy
+            used in the decoder.
+        device (torch.device): Device to generate on.
+
+    Returns:
+        torch.Tensor: The generated sequences on the CPU, of shape
+            `[n_molecules, generate_len + len(prime_input)]`.
+    """
+    generated = []
+    batch_size = n_molecules
+    while n_molecules > 0:
+        current_size = min(batch_size, n_molecules)
+        latent_z = torch.randn(1, current_size, latent_dim, device=device)
+        try:
+            batch = decoder.generate_from_latent(
+                latent_z,
+                prime_input,
+                end_token,
+                search=search,
+                generate_len=generate_len,
+            )
+        except RuntimeError as error:
+            # torch.cuda.OutOfMemoryError (torch>=1.13) is a RuntimeError
+            if "out of memory" not in str(error) or batch_size == 1:
+                raise
+            torch.cuda.empty_cache()
+            batch_size //= 2
+            continue
+        generated.append(batch.cpu())
+        n_molecules -= current_size
+    return torch.cat(generated)
+
+
+def postprocess_molecules(sequences, smiles_language):
+    """
+    Convert generated token index sequences to SMILES.
+
+    Args:
+        sequences (list): Token index lists, cropped to the molecule.
+        smiles_language (SMILESLanguage): Language of the token indexes.
+
+    Returns:
+        list: The non-empty SMILES (converted from SELFIES if necessary).
+    """
+    molecules = map(smiles_language.token_indexes_to_smiles, sequences)
+    # SELFIES conversion if necessary
+    if smiles_language.selfies:
+        molecules = map(smiles_language.selfies_to_smiles, molecules)
+    return [mol.strip() for mol in molecules if mol.strip()]
+
+
+def _write_molecules(filepath, logger, future):
+    # Errors raised in a done-callback only reach the concurrent.futures
+    # logger, report them to the training log instead
+    try:
+        molecules = future.result()
+        if not molecules:
+            return
+        logger.info("\nSample Generated Molecules:\n" + "\n".join(molecules))
+        with open(filepath, "a") as f:
+            f.write("".join(f"{mol}\n" for mol in molecules))
+    except Exception as error:
+        logger.error(
+            f"Generated molecules could not be written to {filepath}: {error}",
+            exc_info=error,
+        )
+
+
+def submit_postprocessing(sequences, smiles_language, filepath, logger):
+    """
+    Convert generated molecules in worker processes and append them to a file.
+
+    Returns immediately, so training continues while the molecules are
+    converted. The pool is created on first use and kept between evaluations.
+
+    Args:
+        sequences (list): Token index lists, cropped to the molecule.
+        smiles_language (SMILESLanguage): Language of the token indexes.
+        filepath (str): File the SMILES are appended to.
+        logger (logging.Logger): Logger the molecules are reported to.
+    """
+    global _postprocess_pool
+    if _postprocess_pool is None:
+        _postprocess_pool = ProcessPoolExecutor(max_workers=POSTPROCESS_WORKERS)
+    # One chunk per worker, the language is pickled once per chunk
+    chunk_size = -(-len(sequences) // POSTPROCESS_WORKERS) or 1
+    for start in range(0, len(sequences), chunk_size):
+        future = _postprocess_pool.submit(
+            postprocess_molecules,
+            sequences[start : start + chunk_size],
+            smiles_language,
+        )
+        # Callbacks run one at a time in the pool's management thread
+        future.add_done_callback(partial(_write_molecules, filepath, logger))
+
+
+def shutdown_postprocessing():
+    """Wait for all submitted molecules to be written and stop the pool."""
+    global _postprocess_pool
+    if _postprocess_pool is not None:
+        _postprocess_pool.shutdown(wait=True)
+        _postprocess_pool = None
+
+
 def _prepare_packed(batch, input_keep, start_index, end_index, device=None):
     encoder_seq, decoder_seq, target_seq = packed_sequential_data_preparation(
-        batch, input_keep=input_keep, start_index=start_index, end_index=end_index
+        batch,
+        input_keep=input_keep,
+        start_index=start_index,
+        end_index=end_index,
+        device=device or get_device(),
     )
 
     return encoder_seq, decoder_seq, target_seq
 
 
 def _prepare_padded(batch, input_keep, start_index, end_index, device):
-    padded_batch = torch.nn.utils.rnn.pad_sequence(batch)
-    padded_batch = padded_batch.to(device)
+    if isinstance(batch, FlatBatch):
+        padded_batch = _pad_flat(*batch, device=device)
+    else:
+        padded_batch = torch.nn.utils.rnn.pad_sequence(batch)
     encoder_seq, decoder_seq, target_seq = sequential_data_preparation(
         padded_batch,
         input_keep=input_keep,
         start_index=start_index,
         end_index=end_index,
+        device=device,
     )
     return encoder_seq, decoder_seq, target_seq
 
 
+def _pad_flat(flat, offsets, device):
+    """Pad a `collate_fn_flat` batch to `[sequence length, batch_size]` on device."""
+    lengths = offsets[1:] - offsets[:-1]
+    max_length = int(lengths.max())
+    flat = flat.to(device, non_blocking=True).long()
+    lengths = lengths.to(device, non_blocking=True)
+    # Batch major, so the mask's row major order matches the flat buffer
+    mask = torch.arange(max_length, device=device) < lengths.unsqueeze(1)
+    padded = torch.zeros(mask.shape, dtype=torch.long, device=device)
+    return padded.masked_scatter_(mask, flat).t().contiguous()
+
+
+def _record_stream(prepared, stream):
+    """Mark tensors made on a side stream as used by `stream` too."""
+    if isinstance(prepared, torch.nn.utils.rnn.PackedSequence):
+        prepared.data.record_stream(stream)
+    elif isinstance(prepared, torch.Tensor):
+        prepared.record_stream(stream)
+    else:
+        for entry in prepared:
+            _record_stream(entry, stream)
+
+
+def prefetch_batches(dataloader, data_preparation, device, **kwargs):
+    """Iterate prepared batches, preparing the next one ahead of time.
+
+    On CUDA the next batch is copied and prepared on a side stream while the
+    current step's kernels are still running on the default stream.
+
+    Args:
+        dataloader (DataLoader): DataLoader object returning batches.
+        data_preparation (callable): Output of `get_data_preparation`.
+        device (torch.device): Device to move the batches to.
+        **kwargs: Passed on to `data_preparation`.
+
+    Yields:
+        (encoder_seq, decoder_seq, target_seq) for every batch.
+    """
+    if device.type != "cuda":
+        for batch in dataloader:
+            yield data_preparation(batch, device=device, **kwargs)
+        return
+
+    copy_stream = torch.cuda.Stream(device=device)
+    pending = None
+    for batch in dataloader:
+        with torch.cuda.stream(copy_stream):
+            prepared = data_preparation(batch, device=device, **kwargs)
+            ready_event = torch.cuda.Event()
+            ready_event.record(copy_stream)
+        if pending is not None:
+            yield pending
+        current_stream = torch.cuda.current_stream(device)
+        current_stream.wait_event(ready_event)
+        _record_stream(prepared, current_stream)
+        pending = prepared
+    if pending is not None:
+        yield pending
+
+
 def get_data_preparation(mode):
     """Select data preparation function mode
 
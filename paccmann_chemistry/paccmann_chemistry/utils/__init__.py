@@ -6,6 +6,8 @@ from .utils import (  # noqa
     perpare_packed_input,
     manage_step_packed_vars,
     collate_fn,
+    collate_fn_flat,
+    FlatBatch,
     kl_weight,
     get_device,
     cuda,
@@ -0,0 +1,71 @@
+"""Datasets of pre-tokenized sequences."""
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+
+class TokenIndexDataset(Dataset):
+    """
+    Token index sequences memory mapped from disk.
+
+    All sequences are stored back to back in one flat array, with an
+    offsets array marking where each one starts. Tokenization happens once
+    when the arrays are written, DataLoader workers then only slice the
+    shared memory map.
+    """
+
+    def __init__(self, filepath_prefix, smiles_language=None):
+        """
+        Args:
+            filepath_prefix (str): Prefix of the `.tokens.npy` and
+                `.offsets.npy` files written by `TokenIndexDataset.save`.
+            smiles_language (SMILESLanguage): Language the token indexes
+                belong to. Defaults to None.
+        """
+        self.token_indexes = np.load(f"{filepath_prefix}.tokens.npy", mmap_mode="r")
+        self.offsets = np.load(f"{filepath_prefix}.offsets.npy")
+        self.smiles_language = smiles_language
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        start, stop = self.offsets[index], self.offsets[index + 1]
+        return torch.from_numpy(self.token_indexes[start:stop].astype(np.int64))
+
+    @classmethod
+    def save(cls, sequences, filepath_prefix, smiles_language=None, num_workers=0):
+        """
+        Write token index sequences to disk and memory map them.
+
+        Args:
+            sequences (Iterable[torch.Tensor]): 1D token index sequences,
+                e.g. an eager `SMILESTokenizerDataset`.
+            filepath_prefix (str): Prefix of the files to write.
+            smiles_language (SMILESLanguage): Language the token indexes
+                belong to. Defaults to None.
+            num_workers (int): If `sequences` is a Dataset, tokenize it in this
+                many worker processes. Defaults to 0 (in the main process).
+
+        Returns:
+            TokenIndexDataset: Dataset reading the written files.
+        """
+        if num_workers > 0 and isinstance(sequences, Dataset):
+            # Items are produced (tokenized) in the workers, order is preserved
+            sequences = DataLoader(
+                sequences, batch_size=None, num_workers=num_workers
+            )
+        arrays = [torch.as_tensor(sequence).cpu().numpy() for sequence in sequences]
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum([len(array) for array in arrays], out=offsets[1:])
+        token_indexes = np.concatenate(arrays) if arrays else np.zeros(0)
+        # Vocabularies are small, keep the file (and page cache) compact
+        max_index = token_indexes.max() if token_indexes.size else 0
+        dtype = np.int16 if max_index <= np.iinfo(np.int16).max else np.int32
+
+        os.makedirs(os.path.dirname(filepath_prefix) or ".", exist_ok=True)
+        np.save(f"{filepath_prefix}.tokens.npy", token_indexes.astype(dtype))
+        np.save(f"{filepath_prefix}.offsets.npy", offsets)
+        return cls(filepath_prefix, smiles_language=smiles_language)
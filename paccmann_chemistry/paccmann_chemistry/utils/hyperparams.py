@@ -1,4 +1,6 @@
 """Model Parameters Module."""
+import inspect
+
 import torch.optim as optim
 from .search import SamplingSearch, GreedySearch, BeamSearch
 
@@ -16,3 +18,30 @@ OPTIMIZER_FACTORY = {
     'rmsprop': optim.RMSprop,
     'sgd': optim.SGD
 }
+
+
+def get_optimizer(name, parameters, lr):
+    """Build an optimizer from OPTIMIZER_FACTORY.
+
+    Uses the fused (or else the multi-tensor foreach) implementation when
+    the installed torch provides one, updating all parameters in a few
+    kernels instead of one per parameter tensor.
+
+    Args:
+        name (str): Choice from OPTIMIZER_FACTORY.
+        parameters (Iterable[torch.nn.Parameter]): Parameters to optimize.
+        lr (float): The learning rate.
+
+    Returns:
+        torch.optim.Optimizer: The optimizer.
+    """
+    optimizer_class = OPTIMIZER_FACTORY[name]
+    parameters = list(parameters)
+    supported = inspect.signature(optimizer_class).parameters
+    kwargs = {}
+    # Fused kernels only accept CUDA parameters
+    if 'fused' in supported and all(p.is_cuda for p in parameters):
+        kwargs['fused'] = True
+    elif 'foreach' in supported:
+        kwargs['foreach'] = True
+    return optimizer_class(parameters, lr=lr, **kwargs)
@@ -0,0 +1,52 @@
+import os
+import tempfile
+import unittest
+import torch
+from paccmann_chemistry.utils.datasets import TokenIndexDataset
+
+SEQUENCES = [
+    torch.tensor([2, 5, 6, 3]),
+    torch.tensor([2, 7, 3]),
+    torch.tensor([2, 4, 4, 4, 4, 3]),
+]
+
+
+class TestTokenIndexDataset(unittest.TestCase):
+    """Testing the TokenIndexDataset."""
+
+    def test_roundtrip(self) -> None:
+        """Test that saved sequences are read back unchanged."""
+        with tempfile.TemporaryDirectory() as directory:
+            dataset = TokenIndexDataset.save(
+                SEQUENCES, os.path.join(directory, 'train')
+            )
+            self.assertEqual(len(dataset), len(SEQUENCES))
+            for sequence, expected in zip(dataset, SEQUENCES):
+                self.assertEqual(sequence.dtype, torch.int64)
+                self.assertListEqual(sequence.tolist(), expected.tolist())
+
+    def test_roundtrip_workers(self) -> None:
+        """Test that tokenizing in worker processes keeps the order."""
+        with tempfile.TemporaryDirectory() as directory:
+            source = TokenIndexDataset.save(
+                SEQUENCES, os.path.join(directory, 'source')
+            )
+            dataset = TokenIndexDataset.save(
+                source, os.path.join(directory, 'train'), num_workers=2
+            )
+            for sequence, expected in zip(dataset, SEQUENCES):
+                self.assertListEqual(sequence.tolist(), expected.tolist())
+
+    def test_smiles_language(self) -> None:
+        """Test that the language is attached to the dataset."""
+        language = object()
+        with tempfile.TemporaryDirectory() as directory:
+            dataset = TokenIndexDataset.save(
+                SEQUENCES, os.path.join(directory, 'test'),
+                smiles_language=language
+            )
+            self.assertIs(dataset.smiles_language, language)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+import torch
+from torch.utils.data import DataLoader
+from paccmann_chemistry.utils import (
+    FlatBatch, collate_fn, collate_fn_flat, packed_sequential_data_preparation
+)
+
+BATCH = [
+    torch.tensor([2, 7, 3]),
+    torch.tensor([2, 4, 4, 4, 4, 3]),
+    torch.tensor([2, 5, 6, 3]),
+]
+
+
+class TestCollateFnFlat(unittest.TestCase):
+    """Testing the collate_fn_flat."""
+
+    def test_collate(self) -> None:
+        """Test that the flat buffer holds the sorted batch."""
+        flat, offsets = collate_fn_flat(BATCH)
+        self.assertEqual(flat.dtype, torch.int32)
+        self.assertListEqual(offsets.tolist(), [0, 6, 10, 13])
+        for index, sequence in enumerate(collate_fn(BATCH)):
+            self.assertListEqual(
+                flat[offsets[index]:offsets[index + 1]].tolist(),
+                sequence.tolist()
+            )
+
+    def test_pin_memory(self) -> None:
+        """Test that batches stay flat through a pinning DataLoader."""
+        loader = DataLoader(
+            BATCH,
+            batch_size=len(BATCH),
+            collate_fn=collate_fn_flat,
+            pin_memory=torch.cuda.is_available()
+        )
+        batch = next(iter(loader))
+        self.assertIsInstance(batch, FlatBatch)
+        self.assertListEqual(batch.offsets.tolist(), [0, 6, 10, 13])
+
+
+class TestPackedSequentialDataPreparation(unittest.TestCase):
+    """Testing the packed_sequential_data_preparation."""
+
+    def test_flat_matches_list(self) -> None:
+        """Test that flat batches are packed like lists of sequences."""
+        device = torch.device('cpu')
+        from_list = packed_sequential_data_preparation(
+            collate_fn(BATCH), device=device
+        )
+        from_flat = packed_sequential_data_preparation(
+            collate_fn_flat(BATCH), device=device
+        )
+        expected = torch.nn.utils.rnn.pack_sequence(collate_fn(BATCH))
+        self.assertListEqual(
+            from_list[0].data.tolist(), expected.data.tolist()
+        )
+        self.assertListEqual(
+            from_list[0].batch_sizes.tolist(), expected.batch_sizes.tolist()
+        )
+        for packed_list, packed_flat in zip(from_list, from_flat):
+            self.assertListEqual(
+                packed_list.data.tolist(), packed_flat.data.tolist()
+            )
+
+    def test_target(self) -> None:
+        """Test that targets are inputs shifted by one, ending with 0."""
+        _, _, target = packed_sequential_data_preparation(
+            collate_fn_flat(BATCH), device=torch.device('cpu')
+        )
+        padded, _ = torch.nn.utils.rnn.pad_packed_sequence(target)
+        self.assertListEqual(padded[:, 2].tolist(), [7, 3, 0, 0, 0, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
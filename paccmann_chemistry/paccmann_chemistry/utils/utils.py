@@ -1,19 +1,22 @@
 """Utilities functions."""
-import copy
 import logging
 import math
+from collections import namedtuple
 
 import numpy as np
 import rdkit.rdBase as rkrb
 import rdkit.RDLogger as rkl
 import torch
-from torch.distributions.bernoulli import Bernoulli
 
 import pytoda
 from pytoda.transforms import Compose
 
 logger = logging.getLogger(__name__)
 
+# A namedtuple, unlike a plain tuple, keeps its type through the DataLoader's
+# pin_memory, so a flat batch stays distinguishable from a list of sequences
+FlatBatch = namedtuple('FlatBatch', ['flat', 'offsets'])
+
 
 def get_device():
     return torch.device(1 if cuda() else "cpu")
@@ -58,25 +61,18 @@ def sequential_data_preparation(
         target_seq (torch.Tensor): Batch of padded target sequences ending
             in the end_index, of size `[sequence length +1, batch_size]`.
     """
-    batch_size = input_batch.shape[1]
-    input_batch = input_batch.long().to(device)
-    decoder_batch = input_batch.clone()
+    input_batch = input_batch.to(device, non_blocking=True).long()
+    decoder_batch = input_batch
     # apply token dropout if keep != 1
     if input_keep != 1:
-        # build dropout indices consisting of dropout_index
-        dropout_indices = torch.LongTensor(
-            dropout_index * torch.ones(1, batch_size).numpy()
-        ).to(device)
-        # mask for token dropout
-        mask = Bernoulli(input_keep).sample((input_batch.shape[0],))
-        mask = torch.LongTensor(mask.numpy())
-        dropout_loc = np.where(mask == 0)[0]
+        # mask for token dropout, drawn on device: a time step is dropped
+        # for the whole batch with probability 1 - input_keep
+        dropout_loc = torch.rand(input_batch.shape[0], 1, device=device) >= input_keep
+        decoder_batch = input_batch.masked_fill(dropout_loc, dropout_index)
 
-        decoder_batch[dropout_loc] = dropout_indices
-
-    end_padding = torch.LongTensor(torch.zeros(1, batch_size).numpy()).to(device)
-    target_seq = torch.cat((input_batch[1:, :], end_padding), dim=0)
-    target_seq = copy.deepcopy(target_seq).to(device)
+    # target is the input shifted by one step, padded with 0 at the end
+    target_seq = torch.zeros_like(input_batch)
+    target_seq[:-1] = input_batch[1:]
 
     return input_batch, decoder_batch, target_seq
 
@@ -93,15 +89,16 @@ def packed_sequential_data_preparation(
     Sequential Training Data Builder.
 
     Args:
-        input_batch (torch.Tensor): Batch of padded sequences, output of
-            nn.utils.rnn.pad_sequence(batch) of size
-            `[sequence length, batch_size, 1]`.
+        input_batch (list or tuple): Batch of sequences sorted from longest
+            to shortest, either as a list of 1D tensors (output of
+            `collate_fn`) or as a `FlatBatch` (output of `collate_fn_flat`).
         input_keep (float): The probability not to drop input sequence tokens
             according to a Bernoulli distribution with p = input_keep.
             Defaults to 1.
         start_index (int): The index of the sequence start token.
         end_index (int): The index of the sequence end token.
         dropout_index (int): The index of the dropout token. Defaults to 1.
+        device (torch.device): Device to be used.
 
     Returns:
     (torch.Tensor, torch.Tensor, torch.Tensor): encoder_seq, decoder_seq,
@@ -115,31 +112,39 @@ def packed_sequential_data_preparation(
             in the end_index, of size `[sequence length +1, batch_size, 1]`.
     """
 
-    def _process_sample(sample):
-        if len(sample.shape) != 1:
+    if isinstance(input_batch, FlatBatch):
+        flat, offsets = input_batch
+    else:
+        if any(len(sample.shape) != 1 for sample in input_batch):
             raise ValueError
-        input = sample.long().to(device)
-        decoder = input.clone()
-
-        # apply token dropout if keep != 1
-        if input_keep != 1:
-            # mask for token dropout
-            mask = Bernoulli(input_keep).sample(input.shape)
-            mask = torch.LongTensor(mask.numpy())
-            dropout_loc = np.where(mask == 0)[0]
-            decoder[dropout_loc] = dropout_index
-
-        # just .clone() propagates to graph
-        target = torch.cat(
-            [input[1:].detach().clone(), torch.Tensor([0]).long().to(device)]
-        )
-        return input, decoder, target.to(device)
+        flat, offsets = collate_fn_flat(input_batch, sort=False)
+    # Process the whole batch as one flat sequence on device instead of
+    # sample by sample
+    lengths = offsets[1:] - offsets[:-1]
+    input = flat.to(device, non_blocking=True).long()
+    decoder = input
+
+    # apply token dropout if keep != 1
+    if input_keep != 1:
+        # mask for token dropout
+        dropout_loc = torch.rand(input.shape, device=device) >= input_keep
+        decoder = input.masked_fill(dropout_loc, dropout_index)
 
-    batch = [_process_sample(sample) for sample in input_batch]
+    # target is every sample shifted by one step, ending with 0
+    target = torch.zeros_like(input)
+    target[:-1] = input[1:]
+    target[offsets[1:].to(device, non_blocking=True) - 1] = 0
+
+    # Pack directly: at each time step take the token of every sequence
+    # still running, indexes are computed on the host where lengths live
+    steps = torch.arange(int(lengths.max())).unsqueeze(1)
+    running = steps < lengths
+    batch_sizes = running.sum(1)
+    packed_index = (offsets[:-1] + steps)[running].to(device, non_blocking=True)
 
-    encoder_decoder_target = zip(*batch)
     encoder_decoder_target = [
-        torch.nn.utils.rnn.pack_sequence(entry) for entry in encoder_decoder_target
+        torch.nn.utils.rnn.PackedSequence(entry[packed_index], batch_sizes)
+        for entry in (input, decoder, target)
     ]
     return encoder_decoder_target
 
@@ -165,6 +170,33 @@ def collate_fn(batch):
     ]
 
 
+def collate_fn_flat(batch, sort=True):
+    """
+    Collate function for DataLoader returning one flat buffer.
+
+    Instead of a list of tensors the batch is concatenated into a single
+    token tensor, so it is moved to the device in one copy and padded or
+    packed there.
+
+    Note: to be used as collate_fn in torch.utils.data.DataLoader.
+
+    Args:
+        batch: Batch of 1D token index sequences.
+        sort (bool): Sort the batch from longest to shortest. Defaults to True.
+
+    Returns:
+        FlatBatch: (flat, offsets)
+        flat is the int32 concatenation of all sequences.
+        offsets is of size `[batch_size + 1]`, sequence i is
+            `flat[offsets[i]:offsets[i + 1]]`.
+    """
+    if sort:
+        batch = collate_fn(batch)
+    offsets = torch.zeros(len(batch) + 1, dtype=torch.long)
+    offsets[1:] = torch.tensor([len(sequence) for sequence in batch]).cumsum(0)
+    return FlatBatch(torch.cat(batch).int(), offsets)
+
+
 def packed_to_padded(seq, target_packed):
     """Converts a sequence of packed outputs into a padded tensor
 